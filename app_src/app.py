@@ -4,38 +4,58 @@ from oauth2client.client import OAuth2WebServerFlow
 from oauth2client.client import flow_from_clientsecrets
 from googleapiclient.errors import HttpError
 from googleapiclient.discovery import build
+import atexit
+import gc
 import json
+import os
+import secrets
 import httplib2
 from beaker.middleware import SessionMiddleware
 from history_db import init_db, log_search, get_recent_searches
-from search_db import search_db, getAllKnownWords
+from popularity import PopularKeywords
+from search_db import search_db, suggest_words
 
 ################################################################### GLOBAL VARIABLES
-global_keyword_dict = Counter() # keeps track of keywords and their occurances among all users
+# keeps track of keywords and their occurances among all users, shared by the server workers
+popular_keywords = PopularKeywords('popularity.db', k=20, sync_interval=float(os.environ.get("POPULARITY_SYNC_INTERVAL", 10)))
+atexit.register(popular_keywords.close)
 paginated_results = []
 
+# sessions are kept in a signed cookie, so no request reads or writes session
+# files. Set SESSION_SECRET so sessions survive restarts; the random fallback
+# is still shared by all workers, since they fork after this module is loaded.
+SESSION_KEY = 'gofetch.session'
 session_opts = {
-    'session.type': 'file',
+    'session.type': 'cookie',
+    'session.key': SESSION_KEY,
+    'session.validate_key': os.environ.get('SESSION_SECRET') or secrets.token_hex(32),
+    'session.data_serializer': 'json',
     'session.cookie_expires': 300,
-    'session.data_dir': './data',
-    'session.auto': True
+    'session.httponly': True,
+    'session.auto': False # the data is only saved when signing in and out
 }
 
 init_db() # initialize database
 
+def signed_in_user():
+    """Return the email of the signed-in user, or None. Requests without a session
+    cookie never load a session."""
+    if SESSION_KEY not in request.cookies:
+        return None
+    return request.environ['beaker.session'].get('user_email')
+
 ################################################################## ROUTING
 # Home page
 @route('/')
 def home():
-    session = request.environ.get('beaker.session')
+    user_email = signed_in_user()
 
     # check if user is logged in
-    if 'user_email' in session: # signed-in mode
-        user_email = session['user_email']
+    if user_email: # signed-in mode
         recent = get_recent_searches(user_email)
-        return template('index', keyword_dict={}, top_20=global_keyword_dict.most_common(20), logged_in=True, user_email=user_email, recent=recent, query="", results=[])
+        return template('index', keyword_dict={}, top_20=popular_keywords.most_common(20), logged_in=True, user_email=user_email, recent=recent, query="", results=[])
     else: # anonymous mode
-        return template('index', keyword_dict={}, top_20=global_keyword_dict.most_common(20), logged_in=False, user_email=None, recent=[], query="", results=[])
+        return template('index', keyword_dict={}, top_20=popular_keywords.most_common(20), logged_in=False, user_email=None, recent=[], query="", results=[])
 
 
 # Loading style.css and other static files
@@ -88,7 +108,7 @@ def redirect_page():
 # Handle input form submission 
 @route('/search', method="GET")
 def formHandler():
-    session = request.environ.get('beaker.session')
+    user_email = signed_in_user()
     keywords = request.query.get('keywords') # input from user
     keyword_dict = Counter() # keeping track of word occurance
     recent = [] # 10 recent searches
@@ -99,21 +119,19 @@ def formHandler():
     if keywords: # if user entered a keyword
         keyword_list = keywords.split()
         keyword_dict.update(keyword_list)
-        global_keyword_dict.update(keyword_list)
+        popular_keywords.add(keyword_list)
 
         # extract from db
         results = search_db(keyword_list[0], page, results_per_page)
 
-        if 'user_email' in session: # signed-in mode
-            user_email = session['user_email']
-
+        if user_email: # signed-in mode
             for kw in keyword_list:
                 log_search(user_email, kw) # add word to database
             recent = get_recent_searches(user_email) # get recent words from database
-            response = template('index', keyword_dict=keyword_dict, top_20=global_keyword_dict.most_common(20),
+            response = template('index', keyword_dict=keyword_dict, top_20=popular_keywords.most_common(20),
                                 logged_in=True, user_email=user_email, recent=recent, query=keyword_list[0], results=results, page=page)
         else: # anonymous mode
-            response = template('index', keyword_dict=keyword_dict, top_20=global_keyword_dict.most_common(20),
+            response = template('index', keyword_dict=keyword_dict, top_20=popular_keywords.most_common(20),
                                 logged_in=False, user_email=None, recent=[], query=keyword_list[0], results=results, page=page)
 
     # clear the URL to prevent resubmission
@@ -124,20 +142,14 @@ def formHandler():
 # Autocomplete
 @route('/autocomplete')
 def autocomplete():
-    query = request.query.get('q').strip().lower() # input from user
+    query = request.query.get('q', '').strip().lower() # input from user
+    response.content_type = 'application/json'
 
     if not query: # if there is no input
-        response.content_type = 'application/json'
         return json.dumps([])
 
-    # get all known keywords
-    allWords = getAllKnownWords()
-
-    # filter those starting with the typed letters
-    suggestions = [word for word in allWords if word.lower().startswith(query)]
-
-    # limit suggestions to 5
-    suggestions = suggestions[:5]
+    # up to 5 known keywords starting with the typed letters, most common first
+    suggestions = suggest_words(query, limit=5)
 
     return json.dumps(suggestions)
 
@@ -147,9 +159,53 @@ def autocomplete():
 def logout():
     # clear user's session data
     session = request.environ.get('beaker.session')
-    session.clear() 
+    session.delete() # expires the cookie
     redirect('/') # redirect to main page
 
 
-app = SessionMiddleware(default_app(), session_opts)
-run(app=app, host='0.0.0.0', port=8080, debug=True, reloader=True)
\ No newline at end of file
+app = SessionMiddleware(default_app(), session_opts) # the WSGI application, e.g. for gunicorn app:app
+
+
+def serve(server="dev", host="0.0.0.0", port=8080, workers=1, threads=4, backlog=2048, keepalive=5):
+    """Run the app.
+
+    "dev" is bottle's single-threaded development server with debug output and
+    the reloader on. "gunicorn" runs workers processes with threads threads
+    each, "waitress" one process with threads threads; both turn debug and the
+    reloader off, keep idle connections open for keepalive seconds and queue
+    up to backlog connections that are not accepted yet."""
+    if server == "dev":
+        run(app=app, host=host, port=port, debug=True, reloader=True)
+    elif server == "gunicorn":
+        # the search index was loaded when search_db was imported, before the
+        # workers are forked, so they all share its pages. Frozen objects are
+        # skipped by the garbage collector, whose passes over them would write
+        # to those pages and leave every worker with its own copy. An index the
+        # crawler rebuilds later is loaded by every worker on its own, see
+        # search_db.refresh_index().
+        gc.freeze()
+        # the gthread worker is the sync worker's counterpart that supports keep-alive
+        run(app=app, server="gunicorn", host=host, port=port, debug=False, reloader=False,
+            workers=workers, threads=threads, worker_class="gthread", backlog=backlog, keepalive=keepalive,
+            preload_app=True)
+    elif server == "waitress":
+        run(app=app, server="waitress", host=host, port=port, debug=False, reloader=False,
+            threads=threads, backlog=backlog, channel_timeout=keepalive)
+    else:
+        raise ValueError("unknown server %r" % server)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Run the GoFetch web server.")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--server", choices=("dev", "gunicorn", "waitress"), default="dev",
+                        help="dev is bottle's debug server, use gunicorn or waitress in production")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="worker processes of the gunicorn server")
+    parser.add_argument("--threads", type=int, default=4, help="threads per worker process")
+    parser.add_argument("--backlog", type=int, default=2048, help="connections waiting to be accepted")
+    parser.add_argument("--keepalive", type=int, default=5, help="seconds an idle connection is kept open")
+    args = parser.parse_args()
+    serve(args.server, args.host, args.port, args.workers, args.threads, args.backlog, args.keepalive)
@@ -0,0 +1,81 @@
+"""Bloom filters for remembering which urls the crawler has already queued.
+
+A Bloom filter answers "have I seen this key?" with no false negatives and a
+small, configurable rate of false positives, in a couple of bytes per key no
+matter how long the keys are. ScalableBloomFilter grows by adding bigger
+filters with tighter error rates, so the overall rate stays below the one
+asked for however many keys are added."""
+
+import hashlib
+import math
+
+
+def _hashes(key):
+    """Return the two 64 bit hashes every filter derives its bit positions from."""
+    digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+    return int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+
+
+class BloomFilter(object):
+    """A fixed size Bloom filter for capacity keys at the given false positive rate."""
+
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.num_bits = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.num_hashes = max(1, int(round(self.num_bits / capacity * math.log(2))))
+        self._bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, hashes):
+        h1, h2 = hashes
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add_hashes(self, hashes):
+        for bit in self._positions(hashes):
+            self._bits[bit >> 3] |= 1 << (bit & 7)
+        self.count += 1
+
+    def contains_hashes(self, hashes):
+        return all(self._bits[bit >> 3] & (1 << (bit & 7)) for bit in self._positions(hashes))
+
+    def add(self, key):
+        self.add_hashes(_hashes(key))
+
+    def __contains__(self, key):
+        return self.contains_hashes(_hashes(key))
+
+
+class ScalableBloomFilter(object):
+    """A Bloom filter that keeps its false positive rate below error_rate as it grows.
+
+    Every time the newest filter is full a new one with twice the capacity and
+    half the error rate is added. Keys are looked up in all of them."""
+
+    def __init__(self, initial_capacity=100000, error_rate=0.001):
+        self.error_rate = error_rate
+        # the rates of the filters add up to error_rate: r/2 + r/4 + ... < r
+        self._filters = [BloomFilter(initial_capacity, error_rate / 2)]
+
+    def add(self, key):
+        """Add key. Returns False if it may have been added before, True if it
+        certainly was not."""
+        hashes = _hashes(key)
+        if any(f.contains_hashes(hashes) for f in self._filters):
+            return False
+        current = self._filters[-1]
+        if current.count >= current.capacity:
+            current = BloomFilter(current.capacity * 2, self.error_rate / 2 ** (len(self._filters) + 1))
+            self._filters.append(current)
+        current.add_hashes(hashes)
+        return True
+
+    def __contains__(self, key):
+        hashes = _hashes(key)
+        return any(f.contains_hashes(hashes) for f in self._filters)
+
+    def __len__(self):
+        return sum(f.count for f in self._filters)
+
+    @property
+    def num_bytes(self):
+        return sum(len(f._bits) for f in self._filters)
@@ -18,13 +18,27 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 import urllib3
-from urllib.parse import urlparse, urldefrag, urljoin
-from urllib.request import urlopen
-from bs4 import BeautifulSoup, Tag
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urlparse, urldefrag, urljoin, urlsplit, urlunsplit
+from urllib.robotparser import RobotFileParser
+from bs4 import BeautifulSoup, Tag, UnicodeDammit
+from collections import defaultdict, deque, OrderedDict
+from html.parser import HTMLParser
+from array import array
+from postings import PostingList, encode_positions
+from segment import write_segment, SegmentReader
+from frontier import MemoryFrontier, SQLiteFrontier
+from bloom import ScalableBloomFilter
+import contextlib
+import hashlib
+import multiprocessing
 import numpy as np
+import os
 import re
 import sqlite3
+import threading
+import time
+import zlib
 
 
 def attr(elem, attr):
@@ -38,6 +52,342 @@ def attr(elem, attr):
 
 WORD_SEPARATORS = re.compile(r'\s|\n|\r|\t|[^a-zA-Z0-9\-_]')
 
+DB_FILE = 'search_engine.db'
+SEGMENT_FILE = 'search_engine.seg'
+FRONTIER_FILE = 'frontier.db'
+
+DESCRIPTION_LENGTH = 300 # characters of the first description line that search results show
+
+USER_AGENT = 'ECE326-crawler/1.0'
+MAX_WAITING = 1000 # urls held back for busy hosts before the frontier stops being read
+
+# query parameters that only track where a visitor came from
+TRACKING_PARAMS = re.compile(r'^(utm_\w+|gclid|dclid|fbclid|msclkid|yclid|mc_cid|mc_eid|_ga|_hsenc|_hsmi)$', re.I)
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+# tags that never have a closing tag, so they can't contain anything
+VOID_TAGS = {'area', 'base', 'basefont', 'br', 'col', 'embed', 'frame', 'hr', 'img', 'input', 'link', 'meta',
+             'param', 'source', 'track', 'wbr'}
+
+
+def decode_html(html):
+    """Decode a downloaded page. Pages that aren't utf-8 get their encoding guessed
+    the same way BeautifulSoup does it."""
+    if isinstance(html, str):
+        return html
+    try:
+        return html.decode("utf-8")
+    except UnicodeDecodeError:
+        return UnicodeDammit(html, is_html=True).unicode_markup
+
+
+class streamed_tag(dict):
+    """Stands in for a bs4 Tag when indexing in streaming mode. It holds the tag
+    name and attributes, which is all the _enter/_exit handlers and attr() use."""
+
+    def __init__(self, name, attrs):
+        dict.__init__(self, ((k, v if v is not None else "") for k, v in attrs))
+        self.name = name
+
+
+class streaming_indexer(HTMLParser):
+    """Indexes a page for a crawler in one pass over its markup, without building
+    a tree. Tags are handed to the crawler's _enter/_exit handlers as they open
+    and close, text goes straight into the crawler's word list, and the title and
+    first three lines of body text are picked up along the way."""
+
+    def __init__(self, bot):
+        HTMLParser.__init__(self, convert_charrefs=True)
+        self._bot = bot
+        self._stack = []  # tags that are currently open
+        self._ignored = None  # name of the ignored tag we are inside of, if any
+        self._ignored_depth = 0
+        self._title_parts = None  # text of the title while we are inside it
+        self._in_body = False
+        self.title = ""
+        self.description = []
+
+    def handle_starttag(self, tag, attrs):
+        # skip an ignored tag and everything in it
+        if self._ignored:
+            if tag == self._ignored:
+                self._ignored_depth += 1
+            return
+        if tag in self._bot._ignored_tags:
+            if tag not in VOID_TAGS:
+                self._ignored = tag
+                self._ignored_depth = 1
+            return
+
+        elem = streamed_tag(tag, attrs)
+        self._bot._enter[tag](elem)
+        if tag in VOID_TAGS:
+            self._bot._exit[tag](elem)
+            return
+        self._stack.append(elem)
+
+        if tag == 'title' and not self.title and self._title_parts is None:
+            self._title_parts = []
+        elif tag == 'body':
+            self._in_body = True
+
+    def handle_endtag(self, tag):
+        if self._ignored:
+            if tag == self._ignored:
+                self._ignored_depth -= 1
+                if not self._ignored_depth:
+                    self._ignored = None
+            return
+
+        # close everything that was left open inside this tag; stray end tags are dropped
+        if not any(elem.name == tag for elem in self._stack):
+            return
+        while True:
+            elem = self._stack.pop()
+            self._bot._exit[elem.name](elem)
+            if elem.name == 'title' and self._title_parts is not None:
+                self.title = " ".join(self._title_parts).strip()
+                self._title_parts = None
+                print("document title=" + repr(self.title))
+            elif elem.name == 'body':
+                self._in_body = False
+            if elem.name == tag:
+                break
+
+    def handle_data(self, data):
+        if self._ignored:
+            return
+        if self._title_parts is not None:
+            self._title_parts.append(data)
+        if self._in_body and len(self.description) < 3:
+            for line in data.strip().splitlines():
+                if line and len(self.description) < 3:
+                    self.description.append(line)
+        self._bot._add_words(data)
+
+
+def canonicalize_url(url):
+    """Return the form of an http(s) url that all its spellings share: the scheme
+    and host lowercased, default ports, fragments and tracking parameters dropped,
+    and repeated slashes in the path collapsed. Other urls are returned as is.
+
+    Trailing slashes are kept, since relative links on the page are resolved
+    against them."""
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    if scheme not in DEFAULT_PORTS:
+        return url
+    try:
+        port = parts.port
+    except ValueError:
+        port = None
+    host = parts.hostname or ""
+    netloc = "[%s]" % host if ":" in host else host
+    if parts.username is not None:
+        userinfo = parts.netloc.rpartition("@")[0]
+        netloc = userinfo + "@" + netloc
+    if port is not None and port != DEFAULT_PORTS[scheme]:
+        netloc += ":%d" % port
+    path = re.sub(r'/{2,}', '/', parts.path) or "/"
+    query = "&".join(p for p in parts.query.split("&") if p and not TRACKING_PARAMS.match(p.split("=", 1)[0]))
+    return urlunsplit((scheme, netloc, path, query, ""))
+
+
+def host_of(url):
+    return urlparse(url).netloc.lower()
+
+
+def shard_of(url, num_shards):
+    """Return which of num_shards shards crawls a url. All urls of a host go to
+    the same shard, so every shard keeps to its own hosts' politeness limits."""
+    return zlib.crc32(host_of(url).encode("utf-8")) % num_shards
+
+
+class fetched_page(bytes):
+    """The body of a downloaded page. url is where it was served from, which
+    differs from the url asked for after redirects."""
+    url = None
+
+
+class host_scheduler(object):
+    """Decides which fetches crawl() starts, so no host gets more than
+    max_per_host requests at a time or one more often than every delay seconds.
+
+    Urls whose host is busy wait in a queue per host, and those queues are
+    served round-robin, so the other hosts keep being crawled while one is slow."""
+
+    def __init__(self, max_per_host=2, delay=0.0):
+        self.max_per_host = max(1, max_per_host)
+        self.delay = delay
+        self._waiting = OrderedDict()  # host -> deque of (url, depth), in round-robin order
+        self._active = defaultdict(int)  # host -> requests in flight
+        self._next_time = {}  # host -> earliest time of its next request
+        self._delays = {}  # host -> delay asked for in its robots.txt
+        self.num_waiting = 0
+
+    def set_delay(self, host, delay):
+        """Wait at least delay seconds between requests to host."""
+        self._delays[host] = delay
+
+    def ready(self, host, now):
+        return self._active[host] < self.max_per_host and self._next_time.get(host, 0.0) <= now
+
+    def defer(self, url, depth):
+        """Hold a url back until its host is ready."""
+        host = host_of(url)
+        if host not in self._waiting:
+            self._waiting[host] = deque()
+        self._waiting[host].append((url, depth))
+        self.num_waiting += 1
+
+    def next_ready(self, now):
+        """Return a held back (url, depth) whose host is ready, or None."""
+        for host in list(self._waiting):
+            if self.ready(host, now):
+                queue = self._waiting[host]
+                item = queue.popleft()
+                if queue:
+                    self._waiting.move_to_end(host)
+                else:
+                    del self._waiting[host]
+                self.num_waiting -= 1
+                return item
+        return None
+
+    def next_wakeup(self):
+        """Return the earliest time a host with held back urls stops waiting on
+        its delay, or None if none of them is. Hosts with max_per_host requests
+        in flight are left out, they are ready again when one of those finishes."""
+        times = [self._next_time[host] for host in self._waiting
+                 if host in self._next_time and self._active.get(host, 0) < self.max_per_host]
+        return min(times) if times else None
+
+    def started(self, host, now):
+        self._active[host] += 1
+        self._next_time[host] = now + max(self.delay, self._delays.get(host, 0.0))
+
+    def finished(self, host):
+        self._active[host] -= 1
+        if not self._active[host]:
+            del self._active[host]
+
+
+class id_table(object):
+    """A dict-like map from the small, dense ids the crawler hands out to values.
+
+    Values live in a list indexed by id, so an entry costs one list slot instead
+    of a hash table entry and a key object. Missing ids hold None."""
+
+    __slots__ = ("_values", "_count")
+
+    def __init__(self):
+        self._values = []
+        self._count = 0
+
+    def __getitem__(self, id_):
+        value = self.get(id_)
+        if value is None:
+            raise KeyError(id_)
+        return value
+
+    def __setitem__(self, id_, value):
+        if id_ >= len(self._values):
+            self._values.extend([None] * (id_ + 1 - len(self._values)))
+        if self._values[id_] is None:
+            self._count += 1
+        self._values[id_] = value
+
+    def get(self, id_, default=None):
+        if 0 <= id_ < len(self._values) and self._values[id_] is not None:
+            return self._values[id_]
+        return default
+
+    def pop(self, id_, default=None):
+        value = self.get(id_)
+        if value is None:
+            return default
+        self._values[id_] = None
+        self._count -= 1
+        return value
+
+    def __contains__(self, id_):
+        return self.get(id_) is not None
+
+    def __iter__(self):
+        return (id_ for id_, value in enumerate(self._values) if value is not None)
+
+    def keys(self):
+        return iter(self)
+
+    def values(self):
+        return (value for value in self._values if value is not None)
+
+    def items(self):
+        return ((id_, value) for id_, value in enumerate(self._values) if value is not None)
+
+    def __len__(self):
+        return self._count
+
+    def __repr__(self):
+        return "id_table(%r)" % dict(self.items())
+
+
+class doc_record(object):
+    """What the crawler knows about one crawled page.
+
+    Slotted, with the description lines kept as one string, so a page costs a
+    fraction of the dict it replaces. Fields can still be read and written like
+    dict keys, e.g. record["title"] or record.get("etag")."""
+
+    FIELDS = ("url", "title", "description", "length", "etag", "last_modified", "content_hash")
+    __slots__ = ("url", "title", "_description", "length", "etag", "last_modified", "content_hash")
+
+    def __init__(self, url, title="", description=(), length=0, etag=None, last_modified=None, content_hash=None):
+        self.url = url
+        self.title = title
+        self.description = description
+        self.length = length
+        self.etag = etag
+        self.last_modified = last_modified
+        self.content_hash = content_hash
+
+    @property
+    def description(self):
+        return self._description.split("\n") if self._description else []
+
+    @description.setter
+    def description(self, lines):
+        self._description = "\n".join(lines)
+
+    def __getitem__(self, key):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self.FIELDS else default
+
+    def update(self, other=(), **fields):
+        for key, value in dict(other, **fields).items():
+            self[key] = value
+
+    def keys(self):
+        return iter(self.FIELDS)
+
+    def items(self):
+        return ((key, getattr(self, key)) for key in self.FIELDS)
+
+    def __eq__(self, other):
+        return hasattr(other, "items") and dict(self.items()) == dict(other.items())
+
+    def __repr__(self):
+        return "doc_record(%r)" % dict(self.items())
+
 
 class crawler(object):
     """Represents 'Googlebot'. Populates a database by crawling and indexing
@@ -46,10 +396,34 @@ class crawler(object):
     This crawler keeps track of font sizes and makes it simpler to manage word
     ids and document ids."""
 
-    def __init__(self, db_conn, url_file):
+    def __init__(self, db_conn, url_file, frontier=None, shard=None, db_file=None):
         """Initialize the crawler with a connection to the database to populate
-        and with the file containing the list of seed URLs to begin indexing."""
-        self._url_queue = []
+        and with the file containing the list of seed URLs to begin indexing.
+
+        frontier holds the urls left to visit, see frontier.py. It defaults to
+        an in-memory one; pass a SQLiteFrontier to make the crawl resumable.
+
+        shard=(index, num_shards) only crawls the hosts shard_of() gives to that
+        shard, and db_file is where the index is stored instead of DB_FILE (its
+        segment file goes next to it). Shards are combined with
+        merge_from_database()."""
+        self._frontier = frontier if frontier is not None else MemoryFrontier()
+        self._shard = shard
+        self._db_file = db_file or DB_FILE
+        self._segment_file = os.path.splitext(db_file)[0] + ".seg" if db_file else SEGMENT_FILE
+
+        # keep-alive connections, pooled per host and shared by the fetch threads
+        self._http = urllib3.PoolManager(num_pools=50, maxsize=8, headers={"User-Agent": USER_AGENT},
+                                         retries=urllib3.Retry(total=None, connect=2, read=2, redirect=5,
+                                                               raise_on_redirect=False))
+        self._robots = {}  # scheme://host -> RobotFileParser
+        self._robots_locks = defaultdict(threading.Lock)
+        self._robots_lock = threading.Lock()
+        self._url_queue = [] # urls found since they were last moved into the frontier
+        self._queued_urls = ScalableBloomFilter() # every url ever put in _url_queue by _queue_url()
+        self._queued_depths = {} # url -> depth of the urls _queue_url() put in _url_queue since it was emptied
+        self._max_depth = float("inf") # depth limit of the running crawl
+        self._backend = "sqlite" # index backend of the running crawl's checkpoints
         self._doc_id_cache = {}
         self._word_id_cache = {}
 
@@ -107,16 +481,20 @@ class crawler(object):
         # keep track of some info about the page we are currently parsing
         self._curr_depth = 0
         self._curr_url = ""
+        self._base_url = "" # what the links of the current page are relative to
         self._curr_doc_id = 0
         self._font_size = 0
         self._curr_words = None
 
         # extended data structures to maintain data between urls
-        self._inverted_index = defaultdict(set) #map word_id to set of doc_ids
-        self._lexicon = {}#map word_id to word
-        self._doc_index = {}#map doc_id to {url, title, description}
-        self._links = defaultdict(set)#store links between docs
+        self._postings = defaultdict(PostingList) #map word_id to {doc_id: (term frequency, max font, summed font, positions)}
+        self._inverted_index = self._postings #map word_id to doc_ids, the same PostingLists read as sets
+        self._lexicon = id_table()#map word_id to word
+        self._doc_index = id_table()#map doc_id to doc_record(url, title, description, ...)
+        self._links = defaultdict(set)#store links between docs, as a sorted array of doc_ids once a page is indexed
         self._page_rank = defaultdict(float)#store page rank values
+        self._doc_urls = id_table()#doc_id to url of every known document
+        self._doc_words = {}#doc_id to word_ids of the documents loaded by load_from_database()
         # get all urls into the queue
         try:
             with open(url_file, 'r') as f:
@@ -172,6 +550,7 @@ class crawler(object):
 
         doc_id = self._mock_insert_document(url)
         self._doc_id_cache[url] = doc_id
+        self._doc_urls[doc_id] = url
         return doc_id
 
     def _fix_url(self, curr_url, rel):
@@ -185,7 +564,7 @@ class crawler(object):
         # compute the new url based on import
         curr_url = urldefrag(curr_url)[0]
         parsed_url = urlparse(curr_url)
-        return urljoin(parsed_url.geturl(), rel)
+        return canonicalize_url(urljoin(parsed_url.geturl(), rel))
 
     def add_link(self, from_doc_id, to_doc_id):
         """Add a link into the database, or increase the number of links between
@@ -197,15 +576,32 @@ class crawler(object):
 
     def _visit_title(self, elem):
         """Called when visiting the <title> tag."""
+        if not isinstance(elem, Tag):
+            return  # streamed tags have no text yet, streaming_indexer prints the title
         title_text = self._text_of(elem).strip()
         print("document title=" + repr(title_text))
 
         # TODO update document title for document id self._curr_doc_id
 
+    def _queue_url(self, url, depth_):
+        """Queue a url found on a page, unless it can't be fetched, is too deep to
+        be visited, or was queued before.
+
+        Repeats are caught by a Bloom filter before they take up room in the
+        queue. A url it has not seen is queued right away; otherwise the queue
+        and the frontier are checked, so a false positive never loses a url."""
+        if depth_ > self._max_depth or not url.startswith(("http://", "https://")):
+            return
+        if not self._queued_urls.add(url) and (self._queued_depths.get(url, depth_ + 1) <= depth_
+                                               or self._frontier.seen(url, depth_)):
+            return
+        self._queued_depths[url] = depth_
+        self._url_queue.append((url, depth_))
+
     def _visit_a(self, elem):
         """Called when visiting <a> tags."""
 
-        dest_url = self._fix_url(self._curr_url, attr(elem, "href"))
+        dest_url = self._fix_url(self._base_url, attr(elem, "href"))
 
         # print "href="+repr(dest_url), \
         #      "title="+repr(attr(elem,"title")), \
@@ -213,7 +609,7 @@ class crawler(object):
         #      "text="+repr(self._text_of(elem))
 
         # add the just found URL to the url queue
-        self._url_queue.append((dest_url, self._curr_depth))
+        self._queue_url(dest_url, self._curr_depth)
 
         # add a link entry into the database from the current document to the
         # other document
@@ -242,7 +638,11 @@ class crawler(object):
     def _add_text(self, elem):
         """Add some text to the document. This records word ids and word font sizes
         into the self._curr_words list for later processing."""
-        words = WORD_SEPARATORS.split(elem.string.lower())
+        self._add_words(elem.string)
+
+    def _add_words(self, text):
+        """Record the word ids and font sizes of every word in some text."""
+        words = WORD_SEPARATORS.split(text.lower())
         for word in words:
             word = word.strip()
             if word in self._ignored_words:
@@ -307,66 +707,328 @@ class crawler(object):
             else:
                 self._add_text(tag)
 
-    def crawl(self, depth=2, timeout=3):
-        """Crawl the web!"""
-        seen = set()
-
-        while len(self._url_queue):
-
-            url, depth_ = self._url_queue.pop()
-
-            # skip this url; it's too deep
-            if depth_ > depth:
-                continue
-
-            doc_id = self.document_id(url)
-
-            # we've already seen this document
-            if doc_id in seen:
-                continue
-
-            seen.add(doc_id)  # mark this document as haven't been visited
-
-            socket = None
+    def _fetch(self, url, timeout, validators=None):
+        """Download the raw contents of a url over a pooled keep-alive connection.
+        This runs on the worker threads of crawl(), so it must not touch any of
+        the crawler's index structures. Urls robots.txt disallows are not fetched.
+
+        validators holds the "etag" and "last_modified" of the copy we already
+        have, if any. They are sent as a conditional request and replaced with the
+        ones the server sends back. Returns None if the page was not modified,
+        otherwise a fetched_page whose url is where redirects ended up."""
+        if not self._robots_for(url, timeout).can_fetch(USER_AGENT, url):
+            raise IOError("robots.txt disallows " + url)
+        headers = {}
+        if validators:
+            if validators.get("etag"):
+                headers["If-None-Match"] = validators["etag"]
+            if validators.get("last_modified"):
+                headers["If-Modified-Since"] = validators["last_modified"]
+        response = self._http.request("GET", url, headers=headers, timeout=timeout)
+        if response.status == 304:
+            return None
+        if response.status >= 400:
+            raise IOError("HTTP %d for %s" % (response.status, url))
+        if response.status >= 300:
+            # still a redirect once the retries allow no more of them
+            raise IOError("too many redirects for %s" % url)
+        if validators is not None:
+            validators["etag"] = response.headers.get("ETag")
+            validators["last_modified"] = response.headers.get("Last-Modified")
+        page = fetched_page(response.data)
+        page.url = urljoin(url, response.geturl() or "")
+        return page
+
+    def _robots_for(self, url, timeout):
+        """Return the robots.txt rules for the host of url, downloading them the
+        first time the host is visited. Hosts without a usable robots.txt allow
+        everything, like RobotFileParser.read() does."""
+        parsed = urlparse(url)
+        site = "%s://%s" % (parsed.scheme, parsed.netloc)
+        with self._robots_lock:
+            lock = self._robots_locks[site]
+        with lock:
+            rules = self._robots.get(site)
+            if rules is not None:
+                return rules
+            rules = RobotFileParser(site + "/robots.txt")
             try:
-                socket = urlopen(url, timeout=timeout)
-                soup = BeautifulSoup(socket.read(), features="html.parser")
-
-                self._curr_depth = depth_ + 1
-                self._curr_url = url
-                self._curr_doc_id = doc_id
-                self._font_size = 0
-                self._curr_words = []
-                self._index_document(soup)
-                self._add_words_to_document()
-                print("    url=" + repr(self._curr_url))
-
-                #store doc info in order with 3 first text lines of text
-                #TODO: store links as well
-                if soup.body:
-                    text = soup.body.get_text("\n\n", strip=True)
-                    description = [l for l in text.splitlines() if l][:3]
+                response = self._http.request("GET", site + "/robots.txt", timeout=timeout)
+                if response.status in (401, 403):
+                    rules.disallow_all = True
+                elif response.status >= 400:
+                    rules.allow_all = True
                 else:
-                    description = []
-                self._doc_index[self._curr_doc_id] = {
-                    "url":self._curr_url,
-                    "title":self._text_of(soup.title).strip() if soup.title else "",
-                    "description": description
-                
-                }
-                
-                #create inverted index
-                for word in self._curr_words:
-                    
-                    #add docs to inverted index
-                    self._inverted_index[word[0]].add(self._curr_doc_id)
-
-            except Exception as e:
-                print(e)
-                pass
-            finally:
-                if socket:
-                    socket.close()
+                    rules.parse(response.data.decode("utf-8", "replace").splitlines())
+            except Exception:
+                rules.allow_all = True
+            self._robots[site] = rules
+            return rules
+
+    def _crawl_delay(self, url):
+        """Return the Crawl-delay robots.txt asks for on the host of url, if any."""
+        parsed = urlparse(url)
+        rules = self._robots.get("%s://%s" % (parsed.scheme, parsed.netloc))
+        return rules.crawl_delay(USER_AGENT) if rules is not None else None
+
+    def _keep_document(self, doc_id, depth_, validators):
+        """Keep a stored page that has not changed since the last crawl. Its index
+        entries stay as they are and the links it had are followed again."""
+        info = self._doc_index[doc_id]
+        for key, value in validators.items():
+            if value:
+                info[key] = value
+        for to_id in self._links.get(doc_id, ()):
+            self._queue_url(self._doc_urls[to_id], depth_ + 1)
+
+    def _forget_document(self, doc_id):
+        """Drop the postings and links of a stored page before it is indexed again."""
+        for word_id in self._doc_words.pop(doc_id, ()):
+            postings = self._postings.get(word_id)
+            if postings is not None:
+                postings.pop(doc_id)
+        self._links.pop(doc_id, None)
+
+    def _start_document(self, url, depth_, doc_id, base_url=None):
+        """Reset the per-page state before indexing a new page. Its links are
+        resolved against base_url, where the page was served from after
+        redirects, which defaults to url."""
+        self._curr_depth = depth_ + 1
+        self._curr_url = url
+        self._base_url = base_url or url
+        self._curr_doc_id = doc_id
+        self._font_size = 0
+        self._curr_words = []
+
+    def _finish_document(self, title, description):
+        """Record the page that was just indexed in the document and inverted indexes."""
+        self._add_words_to_document()
+        print("    url=" + repr(self._curr_url))
+        self._record_document(title, description, len(self._curr_words), self._word_stats())
+
+    def _word_stats(self):
+        """Count every word's occurrences, font sizes and positions in the current page.
+        Returns {word_id: [tf, max_font, sum_font, positions]}."""
+        stats = {}
+        for position, (word_id, font_size) in enumerate(self._curr_words):
+            word_stats = stats.get(word_id)
+            if word_stats is None:
+                word_stats = stats[word_id] = [0, font_size, 0, array('I')]
+            word_stats[0] += 1
+            word_stats[1] = max(word_stats[1], font_size)
+            word_stats[2] += font_size
+            word_stats[3].append(position)
+        return stats
+
+    def _record_document(self, title, description, length, stats):
+        """Add the current page to the document index and its words to the inverted index."""
+        #store doc info in order with 3 first text lines of text
+        self._doc_index[self._curr_doc_id] = doc_record(self._curr_url, title, description, length)
+
+        #the page's links are final now, a sorted array takes a fraction of the memory of a set
+        links = self._links.get(self._curr_doc_id)
+        if links is not None:
+            self._links[self._curr_doc_id] = array('I', sorted(links))
+
+        #create inverted index
+        for word_id, word_stats in stats.items():
+            
+            #add docs to inverted index
+            self._postings[word_id].add(self._curr_doc_id, *word_stats)
+
+    def _merge_parsed_page(self, url, depth_, doc_id, page):
+        """Add a page that page_parser parsed in another process to the index. This
+        is where its words and links get their ids."""
+        title, description, length, stats, links = page
+        self._start_document(url, depth_, doc_id)
+        for link in links:
+            self._queue_url(link, self._curr_depth)
+            self.add_link(doc_id, self.document_id(link))
+        word_id = self.word_id
+        self._record_document(title, description, length, {word_id(word): s for word, s in stats.items()})
+
+    def _index_page(self, url, depth_, doc_id, html, base_url=None):
+        """Parse a downloaded page into a BeautifulSoup tree and add it to the
+        index. Only ever called from the thread running crawl()."""
+        soup = BeautifulSoup(html, features="html.parser")
+
+        self._start_document(url, depth_, doc_id, base_url)
+        self._index_document(soup)
+
+        #TODO: store links as well
+        if soup.body:
+            text = soup.body.get_text("\n\n", strip=True)
+            description = [l for l in text.splitlines() if l][:3]
+        else:
+            description = []
+        self._finish_document(self._text_of(soup.title).strip() if soup.title else "", description)
+
+    def _index_page_streaming(self, url, depth_, doc_id, html, base_url=None):
+        """Add a downloaded page to the index in a single pass over its markup,
+        without building a tree. Only ever called from the thread running crawl()."""
+        self._start_document(url, depth_, doc_id, base_url)
+        parser = streaming_indexer(self)
+        parser.feed(decode_html(html))
+        parser.close()
+        self._finish_document(parser.title, parser.description)
+
+    def crawl(self, depth=2, timeout=3, num_workers=1, streaming=True, checkpoint_every=0, max_per_host=2,
+              host_delay=0.0, num_parsers=0, backend="sqlite"):
+        """Crawl the web!
+
+        Up to num_workers pages are downloaded at the same time by a thread pool.
+        Parsing and index updates stay on the calling thread, so _doc_index,
+        _inverted_index and _links are never modified concurrently. Pages are
+        indexed in one streaming pass unless streaming is False, in which case a
+        BeautifulSoup tree is built for every page.
+
+        Pages already in the index, e.g. after load_from_database(), are fetched
+        with a conditional request and only indexed again if their content hash
+        changed. Unchanged pages keep their postings and links.
+
+        The frontier makes sure every url is visited once. With checkpoint_every
+        set, the index is stored and the frontier committed after that many pages,
+        so a crawl using a SQLiteFrontier can be resumed after a crash. Every
+        checkpoint rewrites the whole index, so once the index holds more than
+        twice checkpoint_every documents the next one comes after half as many
+        pages as it holds; storing the index then costs a few times one store
+        overall instead of growing with the square of the crawl. backend is
+        the one checkpoints store the index with, see store_to_database().
+
+        No host gets more than max_per_host requests at a time, or one more often
+        than every host_delay seconds (or its robots.txt Crawl-delay). Urls of a
+        busy host are held back while other hosts are crawled, see host_scheduler.
+
+        With num_parsers set, pages are parsed by that many processes instead,
+        so parsing uses more than one core. Each sends its page back as words and
+        links, and this process gives out the ids and updates the index as
+        usual, see page_parser."""
+        index_page = self._index_page_streaming if streaming else self._index_page
+        num_workers = max(1, num_workers)
+        scheduler = host_scheduler(max_per_host, host_delay)
+        self._max_depth = depth
+        self._backend = backend
+        in_flight = {}  # future -> (url, depth, doc_id, validators) of the page being fetched
+        parsing = {}  # future -> (url, depth, doc_id, validators, content hash) of the page being parsed
+        max_parsing = 2 * num_parsers  # pages waiting for a parse process before fetching stops
+        num_pages = 0
+        num_unchanged = 0
+        self._num_handled = 0 # pages indexed, unchanged or failed
+        self._next_checkpoint = checkpoint_every
+        start = time.monotonic()
+
+        # parse processes are spawned rather than forked, since the fetch threads may be running
+        parse_pool = ProcessPoolExecutor(num_parsers, mp_context=multiprocessing.get_context("spawn")) \
+            if num_parsers else contextlib.nullcontext()
+        with parse_pool as parsers, ThreadPoolExecutor(max_workers=num_workers) as pool:
+            while True:
+                self._queue_found_urls(depth)
+                if not len(self._frontier) and not in_flight and not parsing and not scheduler.num_waiting:
+                    break
+
+                # keep every worker busy while there are urls left to visit, held back urls first
+                now = time.monotonic()
+                while len(in_flight) < num_workers and (parsers is None or len(parsing) < max_parsing):
+                    item = scheduler.next_ready(now)
+                    if item is None:
+                        if not len(self._frontier) or scheduler.num_waiting >= MAX_WAITING:
+                            break
+                        item = self._frontier.pop()
+                        if not scheduler.ready(host_of(item[0]), now):
+                            scheduler.defer(*item)
+                            continue
+                    url, depth_ = item
+                    doc_id = self.document_id(url)
+                    stored = self._doc_index.get(doc_id, {})
+                    validators = {"etag": stored.get("etag"), "last_modified": stored.get("last_modified")}
+                    in_flight[pool.submit(self._fetch, url, timeout, validators)] = (url, depth_, doc_id, validators)
+                    scheduler.started(host_of(url), now)
+
+                # sleep until a request finishes or a held back host may be visited again;
+                # with every worker busy only a finished request can start another one
+                can_start = len(in_flight) < num_workers and (parsers is None or len(parsing) < max_parsing)
+                wakeup = scheduler.next_wakeup() if can_start else None
+                wait_time = max(0.0, wakeup - now) if wakeup is not None else None
+                if not in_flight and not parsing:
+                    time.sleep(wait_time or 0.0)
+                    continue
+
+                # index pages as soon as they arrive; this may queue up more urls
+                done, _ = wait(list(in_flight) + list(parsing), timeout=wait_time, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future in parsing:
+                        url, depth_, doc_id, validators, content_hash = parsing.pop(future)
+                        try:
+                            self._merge_parsed_page(url, depth_, doc_id, future.result())
+                            self._doc_index[doc_id].update(validators, content_hash=content_hash)
+                            num_pages += 1
+                        except Exception as e:
+                            print(e)
+                        self._page_done(url, depth, checkpoint_every)
+                        continue
+
+                    url, depth_, doc_id, validators = in_flight.pop(future)
+                    scheduler.finished(host_of(url))
+                    crawl_delay = self._crawl_delay(url)
+                    if crawl_delay:
+                        scheduler.set_delay(host_of(url), float(crawl_delay))
+                    try:
+                        html = future.result()
+                        content_hash = hashlib.sha1(html).hexdigest() if html is not None else None
+                        stored = self._doc_index.get(doc_id)
+                        if stored is not None and (html is None or content_hash == stored.get("content_hash")):
+                            self._keep_document(doc_id, depth_, validators)
+                            num_unchanged += 1
+                        else:
+                            if stored is not None:
+                                self._forget_document(doc_id)
+                            base_url = getattr(html, "url", None)
+                            if parsers is not None:
+                                # the page is done once its parse comes back
+                                parsing[parsers.submit(parse_page, url, depth_, bytes(html), streaming, base_url)] = \
+                                    (url, depth_, doc_id, validators, content_hash)
+                                continue
+                            index_page(url, depth_, doc_id, html, base_url)
+                            self._doc_index[doc_id].update(validators, content_hash=content_hash)
+                            num_pages += 1
+                    except Exception as e:
+                        print(e)
+                        pass
+                    self._page_done(url, depth, checkpoint_every)
+
+        elapsed = time.monotonic() - start
+        print("crawled %d pages in %.2fs (%.1f pages/s) with %d workers, %d pages unchanged"
+              % (num_pages, elapsed, num_pages / elapsed if elapsed else 0.0, num_workers, num_unchanged))
+
+    def _page_done(self, url, depth, checkpoint_every):
+        """Mark a url of the running crawl as dealt with, and checkpoint when it
+        is time to, see crawl()."""
+        self._frontier.done(url)
+        self._num_handled += 1
+        if checkpoint_every and self._num_handled >= self._next_checkpoint:
+            self._next_checkpoint = self._num_handled + max(checkpoint_every, len(self._doc_index) // 2)
+            # the links of the pages marked done must be in the frontier before it is committed
+            self._queue_found_urls(depth)
+            self.checkpoint(self._backend)
+
+    def _queue_found_urls(self, depth):
+        """Move the urls found since the last call into the frontier, leaving out
+        those that are too deep to be visited or belong to another shard."""
+        self._frontier.extend(item for item in self._url_queue if item[1] <= depth and self._in_shard(item[0]))
+        del self._url_queue[:]
+        self._queued_depths.clear()
+
+    def _in_shard(self, url):
+        return self._shard is None or shard_of(url, self._shard[1]) == self._shard[0]
+
+    def checkpoint(self, backend="sqlite"):
+        """Store the index with the given backend, see store_to_database(), and
+        commit the frontier, so a crawl that stops after this point resumes from
+        here. PageRank is recomputed first, since the stored page_rank, documents
+        and ranked_postings tables are rebuilt from it."""
+        self.compute_page_rank()
+        self.store_to_database(backend)
+        self._frontier.commit()
 
     def get_inverted_index(self):
         return self._inverted_index
@@ -382,110 +1044,477 @@ class crawler(object):
     def get_doc_description(self, doc_id):
         return self._doc_index[doc_id]["description"] if doc_id in self._doc_index else []
 
-    # could use 1/n as initial pr value but using what they gave in sample because iterations will converge all the same
-    #we replaced xrange with range for python3 compatibility
     #modiified to take mthe links from self._links instead of passing it in
-    def compute_page_rank(self, num_iterations=20, initial_pr=1.0):
-        
-
-        page_rank = defaultdict(lambda: float(initial_pr))
-        num_outgoing_links = defaultdict(float)
-        incoming_link_sets = defaultdict(set)
-        incoming_links = defaultdict(lambda: np.array([]))
+    def compute_page_rank(self, max_iterations=100, tolerance=1e-10, initial_pr=1.0):
+        """Compute the PageRank of every document with power iteration.
+
+        The link graph is turned into a sparse transition matrix once, kept as
+        (row, column, weight) arrays sorted by row, so every iteration is a single
+        sparse matrix-vector product done by numpy. Iteration stops as soon as the
+        total change between two iterations is below tolerance. initial_pr is
+        spread evenly over all documents to start with."""
         damping_factor = 0.85
 
+        # every crawled document and every document with outgoing links is a node
+        doc_ids = sorted(set(self._links) | set(self._doc_index))
+        num_documents = len(doc_ids)
+        if not num_documents:
+            self._page_rank = {}
+            return
+        position = {doc_id: i for i, doc_id in enumerate(doc_ids)}
+
         # using _links dict instead of passing links
         # links format: self._links[from_doc_id] = set([to_doc_id,...])
+        # links to pages we never crawled still count towards the out degree,
+        # their share of the rank just leaves the graph
+        num_outgoing_links = np.zeros(num_documents)
+        sources = []
+        targets = []
         for from_id, to_ids in self._links.items():
-            num_outgoing_links[int(from_id)] += float(len(to_ids))
+            i = position[from_id]
+            num_outgoing_links[i] = len(to_ids)
             for to_id in to_ids:
-                incoming_link_sets[to_id].add(int(from_id))
+                j = position.get(to_id)
+                if j is not None:
+                    sources.append(i)
+                    targets.append(j)
+
+        sources = np.array(sources, dtype=np.int64)
+        targets = np.array(targets, dtype=np.int64)
+        order = np.argsort(targets, kind="stable")
+        rows = targets[order]
+        columns = sources[order]
+        weights = 1.0 / num_outgoing_links[columns]
+
+        # nodes with no outgoing links simulate a random jump to any page
+        dangling_nodes = num_outgoing_links == 0.0
+
+        page_rank = np.full(num_documents, float(initial_pr) / num_documents)
+        lead = (1.0 - damping_factor) / num_documents
 
-     
+        for _ in range(max_iterations):
+            redistribute = damping_factor * page_rank[dangling_nodes].sum() / num_documents
+            tail = damping_factor * np.bincount(rows, weights=weights * page_rank[columns],
+                                                minlength=num_documents)
+            new_page_rank = lead + redistribute + tail
+            change = np.abs(new_page_rank - page_rank).sum()
+            page_rank = new_page_rank
+            if change < tolerance:
+                break
 
-        # this simulates random jump distribution for dangling nodes
-        # convert each set of incoming links into numpy array
-        for doc_id in incoming_link_sets:
-            incoming_links[doc_id] = np.array([from_doc_id for from_doc_id in incoming_link_sets[doc_id]])
-        
-        num_documents = float(len(num_outgoing_links))
-        lead = (1.0 - damping_factor) / num_documents
-        partial_PR = np.vectorize(lambda doc_id: page_rank[doc_id] / num_outgoing_links[doc_id])
-
-        # replaced xrange with range for python3 compatibility
-        for _ in range(num_iterations):
-            #identify nodes with no outgoing links
-            dangling_nodes = [doc for doc in self._doc_index.keys() if num_outgoing_links.get(doc, 0.0) == 0.0]
-            dangling_mass = sum(page_rank[doc] for doc in dangling_nodes)
-            redistribute = damping_factor * dangling_mass / num_documents
-                
-            for doc_id in num_outgoing_links:
-                
-                tail = 0.0
-                if len(incoming_links[doc_id]):
-                    tail = damping_factor * partial_PR(incoming_links[doc_id]).sum()
-                page_rank[doc_id] = lead + tail + redistribute
-        self._page_rank = page_rank
+        self._page_rank = dict(zip(doc_ids, page_rank.tolist()))
 
         #we can move these dbs later when adding more functionality
+    def _bulk_load(self, *writers):
+        """Run the given table writers on one connection and in one transaction.
+
+        The database is kept in WAL mode so the search server's readers are never
+        blocked by the load, fsyncs are skipped while the tables are rebuilt, and
+        each writer only creates its secondary indexes once its rows are in."""
+        conn = sqlite3.connect(self._db_file, isolation_level=None)
+        cursor = conn.cursor()
+        try:
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=OFF")
+            cursor.execute("PRAGMA cache_size=-65536")  # 64MB page cache for the index builds
+            cursor.execute("BEGIN")
+            for write in writers:
+                write(cursor)
+            cursor.execute("COMMIT")
+            # move the load into the main file so the WAL doesn't stay as big as the index
+            cursor.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        except Exception:
+            if conn.in_transaction:
+                cursor.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def _write_page_rank(self, cursor):
+        cursor.execute("DROP TABLE IF EXISTS page_rank")
+        cursor.execute("CREATE TABLE page_rank (doc_id INTEGER PRIMARY KEY, page_rank REAL)")
+        cursor.executemany("INSERT INTO page_rank (doc_id, page_rank) VALUES (?, ?)",
+                           ((int(doc_id), float(pr_value)) for doc_id, pr_value in sorted(self._page_rank.items())))
+
+    def _write_lexicon(self, cursor):
+        cursor.execute("DROP TABLE IF EXISTS lexicon")
+        cursor.execute("CREATE TABLE lexicon (word_id INTEGER PRIMARY KEY, word TEXT, df INTEGER)")
+        cursor.executemany("INSERT INTO lexicon (word_id, word, df) VALUES (?, ?, ?)",
+                           ((word_id, word, len(self._inverted_index.get(word_id, ())))
+                            for word_id, word in sorted(self._lexicon.items())))
+
+    def _write_doc_index(self, cursor):
+        cursor.execute("DROP TABLE IF EXISTS doc_index")
+        cursor.execute("CREATE TABLE doc_index (doc_id INTEGER PRIMARY KEY, url TEXT, title TEXT, description TEXT, "
+                       "length INTEGER, etag TEXT, last_modified TEXT, content_hash TEXT)")
+        cursor.executemany("INSERT INTO doc_index (doc_id, url, title, description, length, etag, last_modified, "
+                           "content_hash) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                           ((doc_id, info["url"], info["title"], "\n".join(info["description"]), info.get("length", 0),
+                             info.get("etag"), info.get("last_modified"), info.get("content_hash"))
+                            for doc_id, info in sorted(self._doc_index.items())))
+
+    def _write_documents(self, cursor):
+        # what a search result shows, with the page rank already joined in, so
+        # search_db reads one row per result
+        cursor.execute("DROP TABLE IF EXISTS documents")
+        cursor.execute("CREATE TABLE documents (doc_id INTEGER PRIMARY KEY, url TEXT, title TEXT, description TEXT, "
+                       "page_rank REAL, length INTEGER)")
+        cursor.executemany("INSERT INTO documents (doc_id, url, title, description, page_rank, length) "
+                           "VALUES (?, ?, ?, ?, ?, ?)",
+                           ((doc_id, info["url"], info["title"],
+                             info["description"][0][:DESCRIPTION_LENGTH] if info["description"] else "",
+                             float(self._page_rank.get(doc_id, 0.0)), info.get("length", 0))
+                            for doc_id, info in sorted(self._doc_index.items())))
+
+    def _write_ranked_postings(self, cursor):
+        # every word's documents by rank, highest page rank first, so a page of
+        # them is a range of the primary key instead of a sort
+        cursor.execute("DROP TABLE IF EXISTS ranked_postings")
+        cursor.execute("CREATE TABLE ranked_postings (word_id INTEGER, rank INTEGER, doc_id INTEGER, "
+                       "PRIMARY KEY (word_id, rank)) WITHOUT ROWID")
+        rank = {doc_id: i for i, doc_id in enumerate(sorted(self._doc_index,
+                                                            key=lambda d: (-self._page_rank.get(d, 0.0), d)))}
+        cursor.executemany("INSERT INTO ranked_postings (word_id, rank, doc_id) VALUES (?, ?, ?)",
+                           ((word_id, doc_rank, doc_id)
+                            for word_id in sorted(self._inverted_index)
+                            for doc_rank, doc_id in sorted((rank[d], d) for d in self._inverted_index[word_id]
+                                                           if d in rank)))
+
+    def _write_links(self, cursor):
+        # every known url keeps its doc_id, so link targets that were never crawled
+        # still resolve when the index is loaded again
+        cursor.execute("DROP TABLE IF EXISTS doc_urls")
+        cursor.execute("CREATE TABLE doc_urls (doc_id INTEGER PRIMARY KEY, url TEXT)")
+        cursor.executemany("INSERT INTO doc_urls (doc_id, url) VALUES (?, ?)",
+                           self._doc_urls.items())
+        cursor.execute("DROP TABLE IF EXISTS links")
+        cursor.execute("CREATE TABLE links (from_doc_id INTEGER, to_doc_id INTEGER, PRIMARY KEY (from_doc_id, to_doc_id))")
+        cursor.executemany("INSERT INTO links (from_doc_id, to_doc_id) VALUES (?, ?)",
+                           ((from_id, to_id) for from_id in sorted(self._links)
+                            for to_id in sorted(self._links[from_id])))
+
+    def _write_inverted_index(self, cursor):
+        # rows go in sorted so the (word_id, doc_id) index is built in one sequential pass
+        cursor.execute("DROP TABLE IF EXISTS inverted_index")
+        cursor.execute("CREATE TABLE inverted_index (word_id INTEGER, doc_id INTEGER, tf INTEGER, max_font INTEGER, "
+                       "sum_font INTEGER, positions BLOB)")
+        cursor.executemany("INSERT INTO inverted_index (word_id, doc_id, tf, max_font, sum_font, positions) "
+                           "VALUES (?, ?, ?, ?, ?, ?)",
+                           ((word_id,) + row
+                            for word_id in sorted(self._inverted_index)
+                            for row in self._posting_rows(word_id)))
+        cursor.execute("CREATE UNIQUE INDEX inverted_index_word_doc ON inverted_index (word_id, doc_id)")
+        cursor.execute("DROP TABLE IF EXISTS segment")
+
+    def _drop_inverted_index(self, cursor):
+        # the postings live in the segment file instead, and search_db orders a
+        # word's documents by page rank from there
+        cursor.execute("DROP TABLE IF EXISTS inverted_index")
+        cursor.execute("DROP TABLE IF EXISTS ranked_postings")
+
+    def _write_segment_version(self, cursor, version):
+        # the version of the segment file this database was built with
+        cursor.execute("DROP TABLE IF EXISTS segment")
+        cursor.execute("CREATE TABLE segment (version INTEGER)")
+        cursor.execute("INSERT INTO segment (version) VALUES (?)", (version,))
+
+    def _posting_rows(self, word_id):
+        """Return (doc_id, tf, max_font, sum_font, encoded positions) for every
+        document of a word, by doc_id. Plain sets of doc_ids get default stats."""
+        postings = self._inverted_index[word_id]
+        if isinstance(postings, PostingList):
+            return sorted(postings.rows())
+        return [(doc_id, 1, 0, 0, b"") for doc_id in sorted(postings)]
+
     def store_page_rank(self):
         """Store the page rank value for a document in the database."""
-        conn = sqlite3.connect('search_engine.db')
-        cursor = conn.cursor()
-        cursor.execute("CREATE TABLE IF NOT EXISTS page_rank (doc_id INTEGER PRIMARY KEY, page_rank REAL)")
-        for doc_id, pr_value in self._page_rank.items():
-            cursor.execute("REPLACE INTO page_rank (doc_id, page_rank) VALUES (?, ?)", (int(doc_id), float(pr_value)))
-        conn.commit()
-        conn.close()
+        self._bulk_load(self._write_page_rank)
 
     def store_lexicon(self):
         """Store the lexicon in the database."""
-        conn = sqlite3.connect('search_engine.db')
-        cursor = conn.cursor()
-        cursor.execute("CREATE TABLE IF NOT EXISTS lexicon (word_id INTEGER PRIMARY KEY, word TEXT)")
-        for word_id, word in self._lexicon.items():
-            cursor.execute("REPLACE INTO lexicon (word_id, word) VALUES (?, ?)", (word_id, word))
-        conn.commit()
-        conn.close()
+        self._bulk_load(self._write_lexicon)
 
     def store_doc_index(self):
-        """Store the document index in the database."""     
-        conn = sqlite3.connect('search_engine.db')
-        cursor = conn.cursor()         
-        cursor.execute("CREATE TABLE IF NOT EXISTS doc_index (doc_id INTEGER PRIMARY KEY, url TEXT, title TEXT, description TEXT)")
-        for doc_id, info in self._doc_index.items():    
-            description_text = "\n".join(info["description"])
-            cursor.execute("REPLACE INTO doc_index (doc_id, url, title, description) VALUES (?, ?, ?, ?)", 
-                           (doc_id, info["url"], info["title"], description_text))
-            
-        conn.commit()
-        conn.close()
+        """Store the document index in the database."""
+        self._bulk_load(self._write_doc_index)
 
-    def store_inverted_index(self): 
+    def store_inverted_index(self):
         """Store the inverted index in the database."""
-        conn = sqlite3.connect('search_engine.db')
-        cursor = conn.cursor()
-        cursor.execute("CREATE TABLE IF NOT EXISTS inverted_index (word_id INTEGER, doc_id INTEGER, PRIMARY KEY (word_id, doc_id))")
-        for word_id, doc_ids in self._inverted_index.items():
-            for doc_id in doc_ids:
-                cursor.execute("REPLACE INTO inverted_index (word_id, doc_id) VALUES (?, ?)", (word_id, doc_id))
-        conn.commit()
-        conn.close()
-
-    def store_to_database(self):
-        """Store all data structures to the database."""
-        self.store_page_rank()
-        self.store_lexicon()
-        self.store_doc_index()
-        self.store_inverted_index()
+        self._bulk_load(self._write_inverted_index)
+
+    def store_documents(self):
+        """Store the search result table and the rank ordered postings, which
+        have to be rebuilt whenever the page ranks change."""
+        self._bulk_load(self._write_documents, self._write_ranked_postings)
+
+    def store_links(self):
+        """Store the link graph and the url of every known document in the database."""
+        self._bulk_load(self._write_links)
+
+    def store_segment(self, path):
+        """Store the inverted index as a compressed segment file at path, see
+        segment.py, and return the version of the file."""
+        return write_segment(path, ((word_id, self._posting_rows(word_id)) for word_id in sorted(self._inverted_index)))
+
+    def store_to_database(self, backend="sqlite"):
+        """Store all data structures to the database in a single transaction.
+
+        With backend="segment" the inverted index goes into the segment file
+        (SEGMENT_FILE by default) instead of the inverted_index and
+        ranked_postings tables, which search_db then reads through mmap. The
+        new segment is moved over the old one only once the rest of the index
+        is committed, and the database records its version, so a segment is
+        never read with a database it wasn't built with."""
+        start = time.monotonic()
+        if backend == "segment":
+            tmp_path = self._segment_file + ".tmp"
+            version = self.store_segment(tmp_path)
+            try:
+                self._bulk_load(self._write_page_rank, self._write_lexicon, self._write_doc_index,
+                                self._write_documents, self._write_links, self._drop_inverted_index,
+                                lambda cursor: self._write_segment_version(cursor, version))
+            except Exception:
+                os.remove(tmp_path)
+                raise
+            os.replace(tmp_path, self._segment_file)
+        elif backend == "sqlite":
+            self._bulk_load(self._write_page_rank, self._write_lexicon, self._write_doc_index,
+                            self._write_documents, self._write_links, self._write_inverted_index,
+                            self._write_ranked_postings)
+            # search_db ignores a segment file once the inverted_index table is
+            # back, so the leftover of an earlier build can go after the commit
+            if os.path.exists(self._segment_file):
+                os.remove(self._segment_file)
+        else:
+            raise ValueError("unknown index backend %r" % backend)
+        print("stored index in %.2fs" % (time.monotonic() - start))
+
+    def load_from_database(self):
+        """Load the index stored by an earlier store_to_database() so the next
+        crawl() only has to index the pages that changed since then.
+
+        Document and word ids are kept, so the stored tables stay valid. The
+        postings are read from the inverted_index table or, with the segment
+        backend, from the segment file."""
+        conn = sqlite3.connect(self._db_file)
+        try:
+            tables = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+
+            for word_id, word in conn.execute("SELECT word_id, word FROM lexicon"):
+                self._lexicon[word_id] = word
+                self._word_id_cache[word] = word_id
+
+            for doc_id, record in self._read_doc_index(conn):
+                self._doc_index[doc_id] = record
+                self._doc_id_cache[record.url] = doc_id
+            if "doc_urls" in tables:
+                for doc_id, url in conn.execute("SELECT doc_id, url FROM doc_urls"):
+                    self._doc_id_cache[url] = doc_id
+            if "links" in tables:
+                for from_id, to_id in conn.execute("SELECT from_doc_id, to_doc_id FROM links ORDER BY from_doc_id, to_doc_id"):
+                    if from_id not in self._links:
+                        self._links[from_id] = array('I')
+                    self._links[from_id].append(to_id)
+
+            self._load_postings(self._read_postings(conn, tables, self._segment_file, sorted(self._lexicon)))
+        finally:
+            conn.close()
+
+        for url, doc_id in self._doc_id_cache.items():
+            self._doc_urls[doc_id] = url
+        self._mock_next_doc_id = max(self._doc_urls, default=0) + 1
+        self._mock_next_word_id = max(self._lexicon, default=0) + 1
+
+    def merge_from_database(self, db_file):
+        """Add the index stored in db_file, e.g. a shard stored by a crawler made
+        with shard=..., to this one.
+
+        Words and documents are given this crawler's ids, looked up by word and
+        url, so shards that numbered them independently combine into one
+        consistent index. A document this crawler already indexed is kept as it
+        is. The page ranks of the shards are dropped; compute_page_rank() over
+        the merged link graph gives the global ones."""
+        segment_file = os.path.splitext(db_file)[0] + ".seg"
+        conn = sqlite3.connect(db_file)
+        try:
+            tables = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+
+            word_ids = {}  # shard word_id -> word_id
+            for word_id, word in conn.execute("SELECT word_id, word FROM lexicon"):
+                word_ids[word_id] = self.word_id(word)
+
+            doc_ids = {}  # shard doc_id -> doc_id
+            if "doc_urls" in tables:
+                for doc_id, url in conn.execute("SELECT doc_id, url FROM doc_urls ORDER BY doc_id"):
+                    doc_ids[doc_id] = self.document_id(url)
+            merged = set()  # shard doc_ids of the documents taken from this shard
+            for doc_id, record in self._read_doc_index(conn):
+                new_id = doc_ids[doc_id] = self.document_id(record.url)
+                if new_id not in self._doc_index:
+                    self._doc_index[new_id] = record
+                    merged.add(doc_id)
+
+            if "links" in tables:
+                links = defaultdict(set)
+                for from_id, to_id in conn.execute("SELECT from_doc_id, to_doc_id FROM links"):
+                    if from_id in merged:
+                        links[doc_ids[from_id]].add(doc_ids[to_id])
+                for from_id, to_ids in links.items():
+                    self._links[from_id] = array('I', sorted(to_ids))
+
+            doc_words = defaultdict(list)
+            for word_id, doc_id, tf, max_font, sum_font, positions \
+                    in self._read_postings(conn, tables, segment_file, sorted(word_ids)):
+                if doc_id in merged:
+                    word_id, doc_id = word_ids[word_id], doc_ids[doc_id]
+                    self._postings[word_id].add(doc_id, tf, max_font, sum_font, positions)
+                    doc_words[doc_id].append(word_id)
+            self._doc_words.update(doc_words)
+        finally:
+            conn.close()
+
+    def _read_doc_index(self, conn):
+        """Yield (doc_id, doc_record) for every row of a stored doc_index table."""
+        doc_columns = {r[1] for r in conn.execute("PRAGMA table_info(doc_index)")}
+        select = ["doc_id", "url", "title", "description"]
+        select += [c if c in doc_columns else "NULL" for c in ("length", "etag", "last_modified", "content_hash")]
+        for doc_id, url, title, description, length, etag, last_modified, content_hash \
+                in conn.execute("SELECT %s FROM doc_index" % ", ".join(select)):
+            yield doc_id, doc_record(url, title, description.split("\n") if description else [],
+                                     length or 0, etag, last_modified, content_hash)
+
+    def _read_postings(self, conn, tables, segment_file, word_ids):
+        """Yield the stored (word_id, doc_id, tf, max_font, sum_font, encoded positions)
+        rows, from the inverted_index table or else from segment_file, where
+        the postings of word_ids are read."""
+        if "inverted_index" in tables:
+            if "tf" in {r[1] for r in conn.execute("PRAGMA table_info(inverted_index)")}:
+                rows = conn.execute("SELECT word_id, doc_id, tf, max_font, sum_font, positions FROM inverted_index")
+            else:
+                rows = conn.execute("SELECT word_id, doc_id, 1, 0, 0, NULL FROM inverted_index")
+            for word_id, doc_id, tf, max_font, sum_font, positions in rows:
+                yield word_id, doc_id, tf, max_font, sum_font, positions or b""
+        elif os.path.exists(segment_file):
+            reader = SegmentReader(segment_file)
+            stored = conn.execute("SELECT version FROM segment").fetchone() if "segment" in tables else None
+            if stored is None or stored[0] != reader.version:
+                reader.close()
+                raise ValueError("%s was not built with this database" % segment_file)
+            try:
+                for word_id in word_ids:
+                    for doc_id, tf, max_font, sum_font, positions in reader.postings(word_id):
+                        yield word_id, doc_id, tf, max_font, sum_font, bytes(positions)
+                        positions = None  # views of the map must be gone before it is closed
+            finally:
+                reader.close()
+
+    def _load_postings(self, postings):
+        """Add stored (word_id, doc_id, tf, max_font, sum_font, encoded positions)
+        rows to the in-memory index."""
+        doc_words = defaultdict(list)
+        for word_id, doc_id, tf, max_font, sum_font, positions in postings:
+            self._postings[word_id].add(doc_id, tf, max_font, sum_font, positions)
+            doc_words[doc_id].append(word_id)
+        self._doc_words = dict(doc_words)
 
     def get_links(self):
         #expand links to name instead of ids
         resolved_links = {self._doc_index[from_id]["url"] : {self._doc_index[to_id]["url"] for to_id in to_ids} 
                             for from_id, to_ids in self._links.items()}
         return resolved_links
-    
+
+
+class page_parser(crawler):
+    """Parses pages in the processes of crawl(num_parsers=...).
+
+    It runs the same tag handlers as crawler, but word_id() and document_id()
+    hand back the word and url themselves, and the page is returned instead of
+    added to an index. The crawling process then only has to give out the ids
+    and update the index, see crawler._merge_parsed_page()."""
+
+    def __init__(self):
+        crawler.__init__(self, None, "")
+        self._page_links = []
+        self._page = None
+
+    def word_id(self, word):
+        return word
+
+    def document_id(self, url):
+        return url
+
+    def add_link(self, from_doc_id, to_doc_id):
+        self._page_links.append(to_doc_id)
+
+    def _queue_url(self, url, depth_):
+        pass  # the crawling process queues the links when it merges the page
+
+    def _record_document(self, title, description, length, stats):
+        self._page = (title, description, length,
+                      {word: (tf, max_font, sum_font, encode_positions(positions))
+                       for word, (tf, max_font, sum_font, positions) in stats.items()},
+                      self._page_links)
+
+    def parse(self, url, depth_, html, streaming=True, base_url=None):
+        """Return (title, description, length, {word: stats}, link urls) of a page."""
+        self._page_links = []
+        index_page = self._index_page_streaming if streaming else self._index_page
+        index_page(url, depth_, url, html, base_url)
+        return self._page
+
+
+_parser = None # page_parser of this parse process
+
+def parse_page(url, depth_, html, streaming, base_url=None):
+    """Parse one page in a parse process, see page_parser.parse()."""
+    global _parser
+    if _parser is None:
+        _parser = page_parser()
+    return _parser.parse(url, depth_, html, streaming, base_url)
+
+
 if __name__ == "__main__":
-    bot = crawler(None, "urls.txt")
-    bot.crawl(depth=1)
-    bot.store_to_database()
+    import argparse
+    parser = argparse.ArgumentParser(description="Crawl the urls in urls.txt and store the index.")
+    parser.add_argument("--incremental", action="store_true",
+                        help="start from the stored index and only re-index pages that changed")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue the crawl that was stopped, from its last checkpoint")
+    parser.add_argument("--parsers", type=int, default=max(0, (os.cpu_count() or 1) - 1),
+                        help="number of processes parsing pages, 0 parses in the crawling process")
+    parser.add_argument("--shard", metavar="I/N",
+                        help="only crawl the hosts of shard I of N, into search_engine.shardI.db")
+    parser.add_argument("--merge", nargs="+", metavar="SHARD_DB",
+                        help="don't crawl, merge the given shard databases into search_engine.db")
+    parser.add_argument("--backend", choices=("sqlite", "segment"), default="sqlite",
+                        help="where the crawl, or --merge, stores the inverted index")
+    parser.add_argument("--workers", type=int, default=8, help="pages downloaded at the same time")
+    # the default urls.txt is one host, which would otherwise get only 2 of the workers
+    parser.add_argument("--per-host", type=int, default=8,
+                        help="requests to one host at the same time, robots.txt Crawl-delay still applies")
+    args = parser.parse_args()
+
+    if args.merge:
+        bot = crawler(None, "empty.txt")
+        for shard_file in args.merge:
+            bot.merge_from_database(shard_file)
+        bot.compute_page_rank()
+        bot.store_to_database(backend=args.backend)
+        raise SystemExit
+
+    shard = db_file = None
+    frontier_file = FRONTIER_FILE
+    if args.shard:
+        shard = tuple(int(n) for n in args.shard.split("/"))
+        db_file = "search_engine.shard%d.db" % shard[0]
+        frontier_file = "frontier.shard%d.db" % shard[0]
+    if not args.resume and os.path.exists(frontier_file):
+        os.remove(frontier_file)
+    frontier = SQLiteFrontier(frontier_file)
+    bot = crawler(None, "urls.txt", frontier=frontier, shard=shard, db_file=db_file)
+    if (args.incremental or args.resume) and os.path.exists(db_file or DB_FILE):
+        bot.load_from_database()
+    bot.crawl(depth=1, num_workers=args.workers, checkpoint_every=500, max_per_host=args.per_host,
+              num_parsers=args.parsers, backend=args.backend)
+    bot.checkpoint(args.backend)
+    frontier.close()
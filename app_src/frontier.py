@@ -0,0 +1,138 @@
+"""Crawl frontiers: the urls a crawl still has to visit and the ones it already took.
+
+Both frontiers hand out every url once, lowest priority first (the crawl depth
+unless given), and remember the urls they handed out so they are never queued
+again. MemoryFrontier keeps everything in memory. SQLiteFrontier keeps it in a
+database file, so memory stays flat however big the frontier gets and a crawl
+can be stopped and resumed from its last commit()."""
+
+import heapq
+import itertools
+import sqlite3
+
+PENDING, TAKEN, DONE = 0, 1, 2 # row states of SQLiteFrontier
+_TAKEN = object() # state of a url MemoryFrontier already handed out
+
+
+class MemoryFrontier(object):
+    """A frontier kept in a heap and a dict, for crawls that fit in memory."""
+
+    def __init__(self):
+        self._heap = []  # (priority, sequence, url, depth)
+        self._counter = itertools.count()
+        self._state = {}  # url -> (depth, sequence) while pending, _TAKEN once handed out
+        self._pending = 0
+
+    def push(self, url, depth, priority=None):
+        """Queue a url unless it was queued before. A pending url found again at
+        a smaller depth is moved up to that depth."""
+        if self.seen(url, depth):
+            return
+        state = self._state.get(url)
+        if state is None:
+            self._pending += 1
+            sequence = next(self._counter)
+        else:
+            sequence = state[1]  # keeps its place among the urls of the new depth
+        self._state[url] = (depth, sequence)
+        heapq.heappush(self._heap, (depth if priority is None else priority, sequence, url, depth))
+
+    def extend(self, items):
+        """Queue every (url, depth) pair of items."""
+        for url, depth in items:
+            self.push(url, depth)
+
+    def seen(self, url, depth):
+        """Return True if pushing url at depth would not change the frontier."""
+        state = self._state.get(url)
+        return state is _TAKEN or (state is not None and state[0] <= depth)
+
+    def pop(self):
+        """Return the (url, depth) to visit next. Raises IndexError when empty."""
+        while self._heap:
+            _, sequence, url, depth = heapq.heappop(self._heap)
+            if self._state.get(url) == (depth, sequence):  # skip entries left behind by a later, smaller depth
+                self._state[url] = _TAKEN
+                self._pending -= 1
+                return url, depth
+        raise IndexError("pop from an empty frontier")
+
+    def done(self, url):
+        """Record that a url handed out by pop() has been dealt with."""
+
+    def commit(self):
+        """Nothing to save for an in-memory frontier."""
+
+    def close(self):
+        pass
+
+    def __len__(self):
+        return self._pending
+
+
+class SQLiteFrontier(object):
+    """A frontier stored in a SQLite database.
+
+    Every url ever queued has one row, which doubles as the seen set. Rows go
+    from pending to taken when pop() hands them out and to done with done().
+    Changes only become durable on commit(), which should follow storing the
+    index, so after a crash the frontier matches the last stored index. Urls
+    that were taken but not done when it was last committed are pending again
+    when the frontier is reopened."""
+
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS frontier (url TEXT PRIMARY KEY, depth INTEGER, "
+                           "priority INTEGER, status INTEGER)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS frontier_next ON frontier (status, priority)")
+        self._conn.execute("UPDATE frontier SET status = ? WHERE status = ?", (PENDING, TAKEN))
+        self._conn.commit()
+        self._pending = self._conn.execute("SELECT COUNT(*) FROM frontier WHERE status = ?", (PENDING,)).fetchone()[0]
+
+    def push(self, url, depth, priority=None):
+        """Queue a url unless it was queued before. A pending url found again at
+        a smaller depth is moved up to that depth."""
+        priority = depth if priority is None else priority
+        cur = self._conn.execute("INSERT OR IGNORE INTO frontier (url, depth, priority, status) VALUES (?, ?, ?, ?)",
+                                 (url, depth, priority, PENDING))
+        if cur.rowcount:
+            self._pending += 1
+        else:
+            self._conn.execute("UPDATE frontier SET depth = ?, priority = ? WHERE url = ? AND status = ? AND depth > ?",
+                               (depth, priority, url, PENDING, depth))
+
+    def extend(self, items):
+        """Queue every (url, depth) pair of items."""
+        for url, depth in items:
+            self.push(url, depth)
+
+    def seen(self, url, depth):
+        """Return True if pushing url at depth would not change the frontier."""
+        row = self._conn.execute("SELECT depth, status FROM frontier WHERE url = ?", (url,)).fetchone()
+        return row is not None and (row[1] != PENDING or row[0] <= depth)
+
+    def pop(self):
+        """Return the (url, depth) to visit next. Raises IndexError when empty."""
+        row = self._conn.execute("SELECT rowid, url, depth FROM frontier WHERE status = ? "
+                                 "ORDER BY priority, rowid LIMIT 1", (PENDING,)).fetchone()
+        if row is None:
+            raise IndexError("pop from an empty frontier")
+        self._conn.execute("UPDATE frontier SET status = ? WHERE rowid = ?", (TAKEN, row[0]))
+        self._pending -= 1
+        return row[1], row[2]
+
+    def done(self, url):
+        """Record that a url handed out by pop() has been dealt with."""
+        self._conn.execute("UPDATE frontier SET status = ? WHERE url = ?", (DONE, url))
+
+    def commit(self):
+        """Make every change since the last commit durable."""
+        self._conn.commit()
+
+    def close(self):
+        """Close the database. Uncommitted changes are dropped."""
+        self._conn.close()
+
+    def __len__(self):
+        return self._pending
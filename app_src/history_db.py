@@ -1,40 +1,204 @@
+import atexit
+import os
 import sqlite3
+import threading
+import time
+from collections import deque
+
+from cache import LRUCache
+
+# Search history is written behind: log_search() only adds the search to the
+# user's ring buffer of recent searches and to a batch that a background thread
+# inserts every FLUSH_INTERVAL seconds, in one transaction. Trimming every user
+# down to their RECENT_LIMIT newest searches is one statement every
+# TRIM_INTERVAL seconds.
+
+DB_PATH = 'history.db'
+RECENT_LIMIT = 10 # searches kept per user
+FLUSH_INTERVAL = float(os.environ.get("HISTORY_FLUSH_INTERVAL", 1.0)) # seconds between batched inserts
+TRIM_INTERVAL = float(os.environ.get("HISTORY_TRIM_INTERVAL", 300)) # seconds between trims
+FLUSH_BATCH = 500 # pending searches that wake the flusher early
+# ring buffers of this many users are kept. They are reloaded after RECENT_TTL
+# seconds, which is how long searches made through other server workers can
+# take to show up.
+RECENT_USERS = int(os.environ.get("HISTORY_RECENT_USERS", 10000))
+RECENT_TTL = float(os.environ.get("HISTORY_RECENT_TTL", 5))
+
+_recent = LRUCache(RECENT_USERS, ttl=RECENT_TTL) # user_email -> deque of keywords, oldest first
+_pending = [] # (user_email, keyword, timestamp) not inserted yet
+_lock = threading.Lock() # guards _pending and the ring buffers
+_db_lock = threading.Lock() # guards the connection; held while a batch is written
+_conn = None
+_conn_pid = None
+_flusher = None
+_flusher_pid = None
+_wakeup = threading.Event()
+_stop = threading.Event()
+
+def _connection():
+    """Return this process's connection to DB_PATH. Call with _db_lock held."""
+    global _conn, _conn_pid
+    if _conn is None or _conn_pid != os.getpid():
+        _conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+        # in WAL mode a commit only has to fsync at checkpoints
+        _conn.execute("PRAGMA journal_mode=WAL")
+        _conn.execute("PRAGMA synchronous=NORMAL")
+        _conn_pid = os.getpid()
+    return _conn
+
+def _before_fork():
+    # no batch may be half written when the process forks, and a connection
+    # must not be used on both sides of a fork
+    global _conn
+    _db_lock.acquire()
+    _lock.acquire()
+    if _conn is not None and _conn_pid == os.getpid():
+        _conn.close()
+    _conn = None
+
+def _after_fork_in_parent():
+    _lock.release()
+    _db_lock.release()
+
+def _after_fork_in_child():
+    # the parent keeps writing its own searches, the child starts out empty and
+    # starts its own flusher when it needs one
+    global _recent, _pending, _lock, _db_lock, _flusher, _wakeup, _stop
+    _recent = LRUCache(RECENT_USERS, ttl=RECENT_TTL)
+    _pending = []
+    _lock = threading.Lock()
+    _db_lock = threading.Lock()
+    _flusher = None
+    _wakeup = threading.Event()
+    _stop = threading.Event()
+os.register_at_fork(before=_before_fork, after_in_parent=_after_fork_in_parent,
+                    after_in_child=_after_fork_in_child)
 
 # create database
 def init_db():
-    conn = sqlite3.connect('history.db')
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS searches (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_email TEXT NOT NULL,
-                    keyword TEXT NOT NULL,
-                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-                )''')
-    conn.commit()
-    conn.close()
+    with _db_lock:
+        conn = _connection()
+        conn.execute('''CREATE TABLE IF NOT EXISTS searches (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        user_email TEXT NOT NULL,
+                        keyword TEXT NOT NULL,
+                        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+                    )''')
+        conn.execute("CREATE INDEX IF NOT EXISTS searches_user_time ON searches (user_email, timestamp)")
+        conn.commit()
+
+def _start_flusher():
+    """Start the background flusher of this process if it isn't running."""
+    global _flusher, _flusher_pid
+    if _flusher is not None and _flusher_pid == os.getpid():
+        return
+    with _lock:
+        if _flusher is not None and _flusher_pid == os.getpid():
+            return
+        _stop.clear()
+        _flusher = threading.Thread(target=_flush_loop, name="history-flusher", daemon=True)
+        _flusher_pid = os.getpid()
+        _flusher.start()
+
+def _flush_loop():
+    last_trim = time.monotonic()
+    while not _stop.is_set():
+        _wakeup.wait(FLUSH_INTERVAL)
+        _wakeup.clear()
+        try:
+            flush()
+            if time.monotonic() - last_trim >= TRIM_INTERVAL:
+                trim()
+                last_trim = time.monotonic()
+        except sqlite3.Error as e:
+            print("history flush failed:", e)
+
+def flush():
+    """Insert every pending search in one transaction."""
+    with _db_lock:
+        with _lock:
+            batch = _pending[:]
+        if not batch:
+            return
+        conn = _connection()
+        with conn:
+            conn.executemany("INSERT INTO searches (user_email, keyword, timestamp) VALUES (?, ?, ?)", batch)
+        # dropped only once they are in, so a failed batch is written with the next one
+        with _lock:
+            del _pending[:len(batch)]
+
+def trim():
+    """Delete all but the RECENT_LIMIT newest searches of every user."""
+    with _db_lock:
+        conn = _connection()
+        with conn:
+            conn.execute("""DELETE FROM searches WHERE id IN (
+                                SELECT id FROM (
+                                    SELECT id, ROW_NUMBER() OVER (PARTITION BY user_email
+                                                                  ORDER BY timestamp DESC, id DESC) AS n
+                                    FROM searches)
+                                WHERE n > ?)""", (RECENT_LIMIT,))
+
+def close():
+    """Stop the flusher and write out the pending searches."""
+    global _conn, _flusher
+    _stop.set()
+    _wakeup.set()
+    if _flusher is not None and _flusher_pid == os.getpid():
+        _flusher.join()
+    _flusher = None
+    flush()
+    with _db_lock:
+        if _conn is not None and _conn_pid == os.getpid():
+            _conn.close()
+        _conn = None
+    _recent.clear()
+atexit.register(close)
+
+def _recent_for(user_email):
+    """Return the user's ring buffer of recent searches, oldest first, loading it
+    from the database and the pending batch if it isn't cached."""
+    recent = _recent.get(user_email)
+    if recent is not None:
+        return recent
+    # holding _db_lock, no batch is between _pending and the table
+    with _db_lock:
+        rows = _connection().execute("""SELECT keyword
+                                        FROM searches
+                                        WHERE user_email=?
+                                        ORDER BY timestamp DESC, id DESC
+                                        LIMIT ?""", (user_email, RECENT_LIMIT)).fetchall()
+        with _lock:
+            recent = deque((row[0] for row in reversed(rows)), maxlen=RECENT_LIMIT)
+            recent.extend(keyword for email, keyword, _ in _pending if email == user_email)
+            _recent.put(user_email, recent)
+    return recent
 
 # insert new search into db
 def log_search(user_email, keyword):
-    conn = sqlite3.connect('history.db')
-    c = conn.cursor()
-    c.execute("INSERT INTO searches (user_email, keyword) VALUES (?, ?)", (user_email, keyword))
-    c.execute("""DELETE FROM searches
-                 WHERE user_email=?
-                 AND id NOT IN (
-                     SELECT id FROM searches WHERE user_email=? ORDER BY timestamp DESC LIMIT 10
-                 )""", (user_email, user_email))
-    conn.commit()
-    conn.close()
+    _start_flusher()
+    _recent_for(user_email) # so the buffer already holds the older searches
+    timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime()) # the format of CURRENT_TIMESTAMP
+    with _lock:
+        _pending.append((user_email, keyword, timestamp))
+        # looked up again, it may have been evicted and reloaded meanwhile
+        recent = _recent.get(user_email)
+        if recent is not None:
+            recent.append(keyword)
+        if len(_pending) >= FLUSH_BATCH:
+            _wakeup.set()
 
 # get up to 10 of the user's recent searches
 def get_recent_searches(user_email, limit=10):
-    conn = sqlite3.connect('history.db')
-    c = conn.cursor()
-    c.execute("""SELECT keyword
-                 FROM searches
-                 WHERE user_email=?
-                 ORDER BY timestamp DESC
-                 LIMIT ?""", (user_email, limit))
-    rows = c.fetchall()
-    conn.close()
-    return [row[0] for row in rows] # return as list of strings not tuples
+    if limit > RECENT_LIMIT:
+        flush()
+        with _db_lock:
+            rows = _connection().execute("""SELECT keyword
+                                            FROM searches
+                                            WHERE user_email=?
+                                            ORDER BY timestamp DESC, id DESC
+                                            LIMIT ?""", (user_email, limit)).fetchall()
+        return [row[0] for row in rows] # return as list of strings not tuples
+    recent = _recent_for(user_email)
+    with _lock:
+        return list(reversed(recent))[:limit]
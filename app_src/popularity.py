@@ -0,0 +1,205 @@
+"""Counting how often keywords are searched, in bounded memory.
+
+A count-min sketch keeps an estimate of every keyword's count in a fixed size
+table, however many distinct keywords there are. It never underestimates, and
+overestimates by at most a small fraction of the total count. Next to it the
+most searched keywords are kept up to date as searches come in, so showing
+them doesn't go over every keyword ever searched.
+
+PopularKeywords also shares the counts between the server's worker processes
+through a SQLite file: every sync adds the searches counted since the last one
+to the table stored there and reads back everyone's, which also keeps them
+across restarts."""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import weakref
+
+import numpy as np
+
+SYNC_TIMEOUT = 10 # seconds a sync waits for another process's sync
+
+
+class CountMinSketch(object):
+    """depth rows of width counters. A key is counted in one counter of every
+    row and its estimate is the smallest of those counters."""
+
+    def __init__(self, width=2 ** 14, depth=4):
+        self.width = width
+        self.depth = depth
+        self.table = np.zeros((depth, width), dtype=np.int64)
+        self._rows = np.arange(depth)
+
+    def _columns(self, key):
+        # two hashes give the column of every row: h1 + row * h2
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + row * h2) % self.width for row in range(self.depth)]
+
+    def add(self, key, count=1):
+        """Count key count more times and return its new estimate."""
+        columns = self._columns(key)
+        self.table[self._rows, columns] += count
+        return int(self.table[self._rows, columns].min())
+
+    def estimate(self, key):
+        """Return how many times key was counted, or a slight overestimate."""
+        return int(self.table[self._rows, self._columns(key)].min())
+
+    def merge(self, other):
+        """Add the counts of a sketch of the same size."""
+        self.table += other.table
+
+
+class PopularKeywords(object):
+    """The k most searched keywords, shared between processes through the
+    SQLite file at path.
+
+    add() and most_common() only touch memory. A background thread of every
+    process syncs the counts every sync_interval seconds, so other workers'
+    searches take up to that long to show, and close() syncs one last time."""
+
+    def __init__(self, path, k=20, width=2 ** 14, depth=4, sync_interval=10.0):
+        self.path = path
+        self.k = k
+        self.sync_interval = sync_interval
+        self._counts = CountMinSketch(width, depth) # everyone's counts as of the last sync, plus ours since
+        self._delta = CountMinSketch(width, depth) # our counts since the last sync
+        self._top = {} # keyword -> estimate of the k most searched keywords
+        self._lock = threading.Lock() # guards the sketches and _top, never held during I/O
+        self._sync_lock = threading.Lock() # one sync at a time
+        self._stop = threading.Event()
+        self._syncer = None
+        self._syncer_pid = None
+        self._sync_logged() # load the stored counts
+        ref = weakref.ref(self)
+        os.register_at_fork(after_in_child=lambda: ref() is not None and ref()._after_fork_in_child())
+
+    def _after_fork_in_child(self):
+        # the parent syncs its own counts, a forked worker starts with none of
+        # its own and starts its own syncer when it needs one
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._syncer = None
+        self._counts.table -= self._delta.table
+        self._delta = CountMinSketch(self._counts.width, self._counts.depth)
+
+    def _start_syncer(self):
+        """Start the background syncer of this process if it isn't running."""
+        if self._syncer is not None and self._syncer_pid == os.getpid():
+            return
+        with self._lock:
+            if self._syncer is not None and self._syncer_pid == os.getpid():
+                return
+            self._stop.clear()
+            self._syncer = threading.Thread(target=self._sync_loop, name="popularity-sync", daemon=True)
+            self._syncer_pid = os.getpid()
+            self._syncer.start()
+
+    def _sync_loop(self):
+        while not self._stop.wait(self.sync_interval):
+            self._sync_logged()
+
+    def _sync_logged(self):
+        try:
+            self.sync()
+        except sqlite3.Error as e:
+            print("popularity sync failed:", e)
+
+    def close(self):
+        """Stop the syncer and sync the counts not stored yet."""
+        self._stop.set()
+        if self._syncer is not None and self._syncer_pid == os.getpid():
+            self._syncer.join()
+        self._syncer = None
+        self._sync_logged()
+
+    def add(self, keywords):
+        """Count one search of every keyword in keywords."""
+        self._start_syncer()
+        with self._lock:
+            for keyword in keywords:
+                self._delta.add(keyword)
+                self._count(keyword, self._counts.add(keyword))
+
+    def _count(self, keyword, estimate):
+        # keep _top the k keywords with the largest estimates
+        if keyword in self._top or len(self._top) < self.k:
+            self._top[keyword] = estimate
+            return
+        least = min(self._top, key=self._top.get)
+        if estimate > self._top[least]:
+            del self._top[least]
+            self._top[keyword] = estimate
+
+    def most_common(self, n=None):
+        """Return up to n (keyword, count) pairs, most searched first, like
+        Counter.most_common()."""
+        self._start_syncer()
+        with self._lock:
+            top = sorted(self._top.items(), key=lambda item: (-item[1], item[0]))
+        return top[:n] if n is not None else top
+
+    def sync(self):
+        """Add our counts since the last sync to the stored ones and load the
+        result, with the stored candidates for the top keywords.
+
+        Searches keep being counted while the database is written. If that
+        fails, the counts are sent with the next sync and the error is raised."""
+        with self._sync_lock:
+            width, depth = self._counts.width, self._counts.depth
+            with self._lock:
+                delta, self._delta = self._delta, CountMinSketch(width, depth)
+                local_top = list(self._top)
+            try:
+                counts, candidates = self._store(delta, local_top)
+            except Exception:
+                with self._lock:
+                    self._delta.merge(delta)
+                raise
+
+            with self._lock:
+                counts.merge(self._delta) # counted while the database was written
+                candidates.update(self._top)
+                top = sorted(((counts.estimate(keyword), keyword) for keyword in candidates),
+                             key=lambda item: (-item[0], item[1]))[:self.k]
+                self._counts = counts
+                self._top = {keyword: estimate for estimate, keyword in top}
+
+    def _store(self, delta, local_top):
+        """Add delta to the stored sketch in one transaction and store the top
+        keywords of the result. Returns the stored sketch and top keywords."""
+        width, depth = delta.width, delta.depth
+        conn = sqlite3.connect(self.path, timeout=SYNC_TIMEOUT, isolation_level=None)
+        try:
+            conn.execute("CREATE TABLE IF NOT EXISTS sketch (id INTEGER PRIMARY KEY CHECK (id = 0), "
+                         "width INTEGER, depth INTEGER, counts BLOB)")
+            conn.execute("CREATE TABLE IF NOT EXISTS top_keywords (keyword TEXT PRIMARY KEY)")
+            conn.execute("BEGIN IMMEDIATE") # one process syncs at a time
+            try:
+                row = conn.execute("SELECT width, depth, counts FROM sketch").fetchone()
+                counts = CountMinSketch(width, depth)
+                if row is not None and row[:2] == (width, depth):
+                    counts.table = np.frombuffer(row[2], dtype=np.int64).reshape(depth, width).copy()
+                counts.merge(delta)
+                conn.execute("INSERT OR REPLACE INTO sketch (id, width, depth, counts) VALUES (0, ?, ?, ?)",
+                             (width, depth, counts.table.tobytes()))
+
+                # the top keywords of all processes are the candidates for the overall top
+                candidates = {r[0] for r in conn.execute("SELECT keyword FROM top_keywords")}
+                candidates.update(local_top)
+                top = sorted(((counts.estimate(keyword), keyword) for keyword in candidates),
+                             key=lambda item: (-item[0], item[1]))[:self.k]
+                conn.execute("DELETE FROM top_keywords")
+                conn.executemany("INSERT INTO top_keywords (keyword) VALUES (?)", ((keyword,) for _, keyword in top))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        finally:
+            conn.close()
+        return counts, {keyword for _, keyword in top}
@@ -0,0 +1,186 @@
+"""Compact byte encodings shared by the crawler, which writes postings, and
+search_db, which reads them.
+
+Integers are stored as unsigned LEB128 varints, so small numbers take one
+byte. Sorted lists such as word positions are stored as the deltas between
+neighbours, which keeps the numbers small. Signed values (font sizes can
+go below zero on badly nested pages) are zigzag encoded first."""
+
+
+def encode_varint(value, out):
+    """Append the varint encoding of a non-negative integer to a bytearray."""
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def decode_varint(buf, pos):
+    """Read one varint from buf starting at pos. Returns (value, next position)."""
+    result = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def zigzag(value):
+    """Map a signed integer to an unsigned one: 0, -1, 1, -2, ... -> 0, 1, 2, 3, ..."""
+    return value * 2 if value >= 0 else -value * 2 - 1
+
+
+def unzigzag(value):
+    """Inverse of zigzag()."""
+    return value >> 1 if not value & 1 else -((value + 1) >> 1)
+
+
+def encode_positions(positions):
+    """Encode a sorted list of word positions as delta varints."""
+    out = bytearray()
+    prev = 0
+    for position in positions:
+        encode_varint(position - prev, out)
+        prev = position
+    return bytes(out)
+
+
+def decode_positions(data):
+    """Decode the output of encode_positions() back into a list of positions."""
+    positions = []
+    pos = 0
+    prev = 0
+    while pos < len(data):
+        delta, pos = decode_varint(data, pos)
+        prev += delta
+        positions.append(prev)
+    return positions
+
+
+def _decode_entry(data, pos):
+    """Decode the PostingList entry at pos. Returns (doc_id, tf, max_font,
+    sum_font, encoded positions) and the position of the next entry."""
+    doc_id, pos = decode_varint(data, pos)
+    tf, pos = decode_varint(data, pos)
+    max_font, pos = decode_varint(data, pos)
+    sum_font, pos = decode_varint(data, pos)
+    size, pos = decode_varint(data, pos)
+    return (doc_id, tf, unzigzag(max_font), unzigzag(sum_font), bytes(data[pos:pos + size])), pos + size
+
+
+class PostingList(object):
+    """The postings of one word while the crawler builds its index, encoded in
+    a single bytearray instead of a dict of tuples. Every document takes its
+    doc_id, tf, zigzag(max_font), zigzag(sum_font) and the size of its positions
+    as varints, followed by the positions from encode_positions().
+
+    It reads like the {doc_id: (tf, max_font, sum_font, positions)} dict it
+    replaces and like a set of doc_ids: iterating gives the doc_ids in the
+    order they were added, and looking up a document decodes its entry.
+
+    The first lookup or removal builds a {doc_id: offset} index of the entries,
+    so lists that are only added to, as in a fresh crawl, stay compact. A
+    removed document's bytes are left in place until the list is read in full
+    or more than half of it is removed, when the live entries are copied into
+    a new bytearray."""
+
+    __slots__ = ("_data", "_count", "_offsets", "_dead")
+
+    def __init__(self):
+        self._data = bytearray()
+        self._count = 0
+        self._offsets = None # doc_id -> offset of its entry, once a lookup needs it
+        self._dead = 0 # bytes of removed entries still in _data
+
+    def add(self, doc_id, tf, max_font, sum_font, positions):
+        """Add a document that is not in the list yet. positions is a sorted
+        sequence of word positions or the bytes encode_positions() made of it."""
+        if not isinstance(positions, (bytes, bytearray)):
+            positions = encode_positions(positions)
+        data = self._data
+        if self._offsets is not None:
+            self._offsets[doc_id] = len(data)
+        encode_varint(doc_id, data)
+        encode_varint(tf, data)
+        encode_varint(zigzag(max_font), data)
+        encode_varint(zigzag(sum_font), data)
+        encode_varint(len(positions), data)
+        data += positions
+        self._count += 1
+
+    def _index(self):
+        if self._offsets is None:
+            offsets = {}
+            pos = 0
+            while pos < len(self._data):
+                row, next_pos = _decode_entry(self._data, pos)
+                offsets[row[0]] = pos
+                pos = next_pos
+            self._offsets = offsets
+        return self._offsets
+
+    def _compact(self):
+        # copy the entries still in the index, the live ones, into a new bytearray
+        data, offsets = self._data, self._offsets
+        self._data = bytearray()
+        self._count = 0
+        self._offsets = {}
+        self._dead = 0
+        for offset in sorted(offsets.values()):
+            self.add(*_decode_entry(data, offset)[0])
+
+    def rows(self):
+        """Yield (doc_id, tf, max_font, sum_font, encoded positions) per document."""
+        if self._dead:
+            self._compact()
+        pos = 0
+        while pos < len(self._data):
+            row, pos = _decode_entry(self._data, pos)
+            yield row
+
+    def items(self):
+        for doc_id, tf, max_font, sum_font, positions in self.rows():
+            yield doc_id, (tf, max_font, sum_font, decode_positions(positions))
+
+    def get(self, doc_id, default=None):
+        offset = self._index().get(doc_id)
+        if offset is None:
+            return default
+        row, _ = _decode_entry(self._data, offset)
+        return row[1:4] + (decode_positions(row[4]),)
+
+    def __getitem__(self, doc_id):
+        posting = self.get(doc_id)
+        if posting is None:
+            raise KeyError(doc_id)
+        return posting
+
+    def pop(self, doc_id, default=None):
+        """Remove a document and return its posting, or default if it is not in the list."""
+        offset = self._index().pop(doc_id, None)
+        if offset is None:
+            return default
+        row, end = _decode_entry(self._data, offset)
+        self._dead += end - offset
+        self._count -= 1
+        if self._dead * 2 > len(self._data):
+            self._compact()
+        return row[1:4] + (decode_positions(row[4]),)
+
+    def discard(self, doc_id):
+        self.pop(doc_id)
+
+    def __iter__(self):
+        return (row[0] for row in self.rows())
+
+    def __contains__(self, doc_id):
+        return doc_id in self._index()
+
+    def __len__(self):
+        return self._count
+
+    def __repr__(self):
+        return "PostingList(%r)" % dict(self.items())
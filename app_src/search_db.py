@@ -1,55 +1,364 @@
 import sqlite3
 import os
+import heapq
+import threading
+import bisect
+import math
 
+from collections import defaultdict
 from difflib import SequenceMatcher
-import sqlite3
-from difflib import SequenceMatcher
+import numpy as np
+from urllib.request import pathname2url
+from cache import LRUCache
+from segment import SegmentReader
 
 DB_PATH = os.path.join(os.path.dirname(__file__), 'search_engine.db')
-#module-level cache dictionaries
-_fuzzy_cache = {}
-_lexicon = {}
-_lexicon_dict = {}
-_match_cache = {}
-_search_cache = {}
+#written by crawler.store_to_database(backend="segment") in place of the inverted_index table
+SEGMENT_PATH = os.path.join(os.path.dirname(__file__), 'search_engine.seg')
+
+#cache limits, can be overridden from the environment (e.g. in app.service)
+FUZZY_CACHE_SIZE = int(os.environ.get("FUZZY_CACHE_SIZE", 50000))
+MATCH_CACHE_SIZE = int(os.environ.get("MATCH_CACHE_SIZE", 5000))
+SEARCH_CACHE_SIZE = int(os.environ.get("SEARCH_CACHE_SIZE", 1000))
+SEARCH_CACHE_TTL = float(os.environ.get("SEARCH_CACHE_TTL", 600)) or None # seconds, 0 disables expiry
+
+#similarity of two words doesn't depend on the index, so this cache outlives rebuilds
+_fuzzy_cache = LRUCache(FUZZY_CACHE_SIZE)
+_index = None # the _Index searches read, replaced as a whole by refresh_index()
+_mismatched_version = None # _db_version() whose segment file didn't belong to the database
+_reload_lock = threading.Lock()
+_MISSING = object()
+
+def _db_version():
+    """Return (mtime, size) of DB_PATH followed by those of SEGMENT_PATH, or
+    None if the database does not exist."""
+    try:
+        st = os.stat(DB_PATH)
+    except OSError:
+        return None
+    try:
+        seg = os.stat(SEGMENT_PATH)
+    except OSError:
+        return (st.st_mtime_ns, st.st_size, None, None)
+    return (st.st_mtime_ns, st.st_size, seg.st_mtime_ns, seg.st_size)
+
+class _SegmentMismatch(Exception):
+    """The segment file isn't the one the database was built with."""
+
+#one read-only connection per thread, reused across requests
+_local = threading.local()
+
+def get_connection(version=None):
+    """Return the calling thread's read-only connection to DB_PATH.
+
+    The connection is opened once per thread with memory-mapped reads and a
+    larger page cache, and the sqlite3 module keeps the prepared statements of
+    every query run on it. It is reopened for another version of the database
+    or when the process has forked, since SQLite connections can't cross a fork.
+
+    Args:
+        version: The _Index.version the caller reads. Defaults to the index
+            this thread is loading, if any, else to the published one.
+
+    Returns:
+        sqlite3.Connection: A connection whose rows are sqlite3.Row objects.
+    """
+    if version is None:
+        version = getattr(_local, "loading", None) or _index.version
+    conn = getattr(_local, "conn", None)
+    if conn is not None and _local.pid == os.getpid() and _local.version == version:
+        return conn
+    if conn is not None and _local.pid == os.getpid():
+        conn.close()
+
+    conn = sqlite3.connect("file:%s?mode=ro" % pathname2url(DB_PATH), uri=True, cached_statements=256)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA query_only=ON")
+    conn.execute("PRAGMA mmap_size=268435456") # 256MB
+    conn.execute("PRAGMA cache_size=-16384") # 16MB
+    _local.conn = conn
+    _local.pid = os.getpid()
+    _local.version = version
+    return conn
+
+def _close_connection():
+    """Close the calling thread's connection before the process forks, e.g. into
+    server workers, so a child never inherits one it could later close under
+    its parent."""
+    conn = getattr(_local, "conn", None)
+    if conn is not None and _local.pid == os.getpid():
+        conn.close()
+    _local.conn = None
+os.register_at_fork(before=_close_connection)
+
+def _table_columns(table):
+    """Return the column names of a table in the search database. Databases built
+    by older crawlers lack some of the columns used for ranking."""
+    return {r["name"] for r in get_connection().execute("PRAGMA table_info(%s)" % table)}
+
+def _has_documents():
+    """Return True if the crawler wrote the denormalized documents table, which
+    replaces the page_rank joins."""
+    return bool(_table_columns("documents"))
+
 def load_lexicon():
     """Load all entries from the 'lexicon' table in the configured SQLite database.
 
     Opens a connection to the SQLite database referenced by DB_PATH, sets the
     connection's row factory to sqlite3.Row, and executes a SELECT query to
-    retrieve the `word_id` and `word` columns from the `lexicon` table. The
-    database connection is closed before returning.
+    retrieve the `word_id`, `word` and `df` columns from the `lexicon` table. The
+    thread's pooled connection from get_connection() is used and left open.
 
     Returns:
         list[sqlite3.Row]: A list of sqlite3.Row objects (can be accessed by key
-        or index). Each row contains the keys 'word_id' and 'word'.
+        or index). Each row contains the keys 'word_id', 'word' and 'df', the
+        number of documents the word appears in.
 
     Raises:
         sqlite3.Error: If an error occurs while connecting to the database or
         executing the query.
     """
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-    cur.execute("SELECT word_id, word FROM lexicon")
-    rows = cur.fetchall()
-    conn.close()
-    return rows
-
-_lexicon = load_lexicon()#load lexicon at module load time
-
-def load_lexicon_dictionary(): 
+    cur = get_connection().cursor()
+    if "df" in _table_columns("lexicon"):
+        cur.execute("SELECT word_id, word, df FROM lexicon")
+    else:
+        cur.execute("""
+            SELECT l.word_id, l.word, COUNT(ii.doc_id) AS df
+            FROM lexicon AS l
+            LEFT JOIN inverted_index AS ii ON ii.word_id = l.word_id
+            GROUP BY l.word_id
+        """)
+    return cur.fetchall()
+
+def load_lexicon_dictionary(lexicon): 
     """Load the lexicon into a dictionary for faster access."""
     lex_dict = {}
-    for row in _lexicon:
+    for row in lexicon:
         lex_dict[row["word"].lower()] = row
     return lex_dict
-_lexicon_dict = load_lexicon_dictionary()
+
+def load_segment():
+    """Open the segment file if the index was built with the segment backend.
+
+    The segment backend drops the inverted_index table in the same transaction
+    that stores the rest of the index, so a database that has the table was
+    built with the sqlite backend, and a segment file next to it is left over
+    from an earlier build (the crawler removes it only after its commit).
+    Otherwise the segment's version has to be the one the database records;
+    the crawler moves a new segment in right after committing the database.
+
+    Returns:
+        tuple: (SegmentReader or None, page rank per doc_id, length per doc_id).
+        The arrays stand in for the joins the inverted_index query does and are
+        None without a segment file.
+
+    Raises:
+        _SegmentMismatch: If the segment file belongs to another build.
+    """
+    if not os.path.exists(SEGMENT_PATH) or _table_columns("inverted_index"):
+        return None, None, None
+    cur = get_connection().cursor()
+    segment = SegmentReader(SEGMENT_PATH)
+    stored = cur.execute("SELECT version FROM segment").fetchone() if _table_columns("segment") else None
+    if stored is None or stored[0] != segment.version:
+        segment.close()
+        raise _SegmentMismatch(SEGMENT_PATH)
+    cur.execute("SELECT MAX(doc_id) FROM doc_index")
+    size = (cur.fetchone()[0] or 0) + 1
+    ranks = np.zeros(size)
+    lengths = np.zeros(size, dtype=np.int64)
+    if _has_documents():
+        for doc_id, pr, length in cur.execute("SELECT doc_id, page_rank, length FROM documents"):
+            ranks[doc_id] = pr
+            lengths[doc_id] = length or 0
+        return segment, ranks, lengths
+    for doc_id, length in cur.execute("SELECT doc_id, length FROM doc_index"):
+        lengths[doc_id] = length or 0
+    for doc_id, pr in cur.execute("SELECT doc_id, page_rank FROM page_rank WHERE doc_id < ?", (size,)):
+        ranks[doc_id] = pr
+    return segment, ranks, lengths
+
+def load_collection_stats(segment):
+    """Return the document count and average document length used by BM25, and
+    which per-posting statistics the database has."""
+    postings_stats = segment is not None or "tf" in _table_columns("inverted_index")
+    doc_lengths = "length" in _table_columns("doc_index")
+    cur = get_connection().cursor()
+    cur.execute("SELECT COUNT(*), %s FROM doc_index" % ("AVG(length)" if doc_lengths else "1.0"))
+    num_docs, avg_length = cur.fetchone()
+    return {
+        "num_docs": num_docs,
+        "avg_doc_length": avg_length or 1.0,
+        "postings_stats": postings_stats,
+        "doc_lengths": doc_lengths,
+        "documents": _has_documents(),
+        # the segment backend leaves the rank order to the segment and doc_ranks
+        "ranked_postings": bool(_table_columns("ranked_postings")),
+    }
+
+# characters the crawler keeps in words, anything else is counted in one extra column
+_FUZZY_ALPHABET = {c: i for i, c in enumerate("abcdefghijklmnopqrstuvwxyz0123456789-_")}
+_FUZZY_CANDIDATES = 50 # words picked from the bigram index before the exactness pass
+
+def _bigrams(word):
+    """Return the set of bigrams of a word padded with '$' on both ends."""
+    padded = "$" + word + "$"
+    return {padded[i:i + 2] for i in range(len(padded) - 1)}
+
+def _char_counts(word):
+    """Return how many times each character of _FUZZY_ALPHABET appears in word,
+    as uint16 counts capped at 65535. SequenceMatcher treats a character that
+    makes up more than 1% of a word of 200 or more as junk and never matches
+    it, so the cap can't lower the bound lexicon_fuzzy_match() takes from them."""
+    counts = np.bincount([_FUZZY_ALPHABET.get(ch, len(_FUZZY_ALPHABET)) for ch in word],
+                         minlength=len(_FUZZY_ALPHABET) + 1)
+    return np.minimum(counts, np.iinfo(np.uint16).max).astype(np.uint16)
+
+def build_fuzzy_index(lexicon):
+    """Build the candidate index used by lexicon_fuzzy_match() from the lexicon.
+
+    Words are referred to by their position in the lexicon. Everything is kept in
+    numpy arrays rather than lists of ints, whose reference counts would change
+    on every lookup, so the pages stay shared between forked server workers.
+
+    Returns:
+        tuple: (bigram -> array of positions, number of bigrams per word,
+        character count matrix with one row per word, word lengths)
+    """
+    postings = defaultdict(list)
+    gram_counts = np.zeros(len(lexicon), dtype=np.int32)
+    char_matrix = np.zeros((len(lexicon), len(_FUZZY_ALPHABET) + 1), dtype=np.uint16)
+    lengths = np.zeros(len(lexicon), dtype=np.int32)
+    for i, row in enumerate(lexicon):
+        word = row["word"].lower()
+        grams = _bigrams(word)
+        for gram in grams:
+            postings[gram].append(i)
+        gram_counts[i] = len(grams)
+        char_matrix[i] = _char_counts(word)
+        lengths[i] = len(word)
+    postings = {gram: np.array(positions, dtype=np.int32) for gram, positions in postings.items()}
+    return postings, gram_counts, char_matrix, lengths
+
+_PRECOMPUTED_PREFIX_LENGTH = 2 # suggestions for prefixes this short are computed at load time
+_PRECOMPUTED_SUGGESTIONS = 10
+
+def build_prefix_index(lexicon):
+    """Build the autocomplete index from the lexicon.
+
+    Returns:
+        tuple: (lowercased words in sorted order, array of their document
+        frequencies, {short prefix: precomputed suggestions})
+    """
+    rows = sorted((r["word"].lower(), r["df"]) for r in lexicon)
+    words = [w for w, _ in rows]
+    freqs = np.array([df for _, df in rows], dtype=np.int64)
+
+    # a one or two letter prefix can match a big part of the lexicon, so rank those ahead of time
+    short_prefixes = {w[:n] for w in words for n in range(1, _PRECOMPUTED_PREFIX_LENGTH + 1)}
+    top = {p: _rank_prefix_range(words, freqs, p, _PRECOMPUTED_SUGGESTIONS) for p in short_prefixes}
+    return words, freqs, top
+
+def _rank_prefix_range(words, freqs, prefix, limit):
+    """Return the limit words starting with prefix that appear in the most documents."""
+    lo = bisect.bisect_left(words, prefix)
+    hi = bisect.bisect_left(words, prefix + chr(0x10FFFF), lo)
+    # words are sorted, so the stable sort breaks ties alphabetically; only the
+    # words returned are touched
+    best = np.argsort(-freqs[lo:hi], kind="stable")[:limit]
+    return [words[lo + i] for i in best.tolist()]
+
+class _Index(object):
+    """Everything searches read from one version of search_engine.db.
+
+    It is built in full before refresh_index() publishes it with one assignment
+    and is not changed afterwards, so a search that takes _index once, at its
+    start, never mixes two versions. Its version is the _db_version() it was
+    loaded from, which searches pass to get_connection(). The match and search
+    caches hold results computed from it and are replaced along with it."""
+
+    __slots__ = ("version", "lexicon", "lexicon_dict", "doc_freq", "segment", "doc_ranks", "doc_lengths",
+                 "collection", "bigram_index", "bigram_counts", "char_matrix", "word_lengths",
+                 "prefix_words", "prefix_freqs", "prefix_top", "match_cache", "search_cache")
+
+    def __init__(self, version):
+        self.version = version
+        _local.loading = version # the loaders' connections are opened on this version
+        try:
+            self.lexicon = load_lexicon()
+            self.doc_freq = {row["word_id"]: row["df"] for row in self.lexicon}
+            self.segment, self.doc_ranks, self.doc_lengths = load_segment()
+            self.collection = load_collection_stats(self.segment)
+        finally:
+            _local.loading = None
+        self.lexicon_dict = load_lexicon_dictionary(self.lexicon)
+        self.bigram_index, self.bigram_counts, self.char_matrix, self.word_lengths = build_fuzzy_index(self.lexicon)
+        self.prefix_words, self.prefix_freqs, self.prefix_top = build_prefix_index(self.lexicon)
+        self.match_cache = LRUCache(MATCH_CACHE_SIZE)
+        self.search_cache = LRUCache(SEARCH_CACHE_SIZE, ttl=SEARCH_CACHE_TTL)
+
+def suggest_words(prefix, limit=5):
+    """Return up to limit lexicon words starting with prefix, most frequent first.
+
+    Short prefixes are answered from the precomputed table, longer ones with a
+    binary search over the sorted lexicon, so this never scans the whole lexicon.
+    """
+    prefix = prefix.lower()
+    if not prefix:
+        return []
+    index = refresh_index()
+    if len(prefix) <= _PRECOMPUTED_PREFIX_LENGTH and limit <= _PRECOMPUTED_SUGGESTIONS:
+        return index.prefix_top.get(prefix, [])[:limit]
+    return _rank_prefix_range(index.prefix_words, index.prefix_freqs, prefix, limit)
+
+def refresh_index():
+    """Return the current _Index, first loading a new one if search_engine.db
+    changed since it was loaded, e.g. because the crawler rebuilt it. A stat
+    call is all this costs when nothing changed.
+
+    Callers keep the returned index for the rest of their search instead of
+    reading _index again.
+
+    A forked server worker shares the index it inherited only until then: each
+    worker loads the new one on its own, into its own memory. Only the postings
+    of the segment backend stay shared, through the page cache, so restart the
+    server after a rebuild to share everything again."""
+    global _index, _mismatched_version
+    index = _index
+    version = _db_version()
+    if version == index.version or version is None or version == _mismatched_version:
+        return index
+    with _reload_lock:
+        if version == _index.version:
+            return _index
+        try:
+            new_index = _Index(version)
+        except _SegmentMismatch:
+            # the database is committed but its segment not moved in yet, which
+            # changes the version again; keep the old index until then
+            _mismatched_version = version
+            return _index
+        # the old index, and its segment reader, are left to the garbage
+        # collector, searches may still be reading them
+        _index = new_index
+        return _index
+
+def cache_stats():
+    """Return the size and hit/miss/eviction counters of every search cache."""
+    index = _index
+    return {
+        "fuzzy": _fuzzy_cache.stats(),
+        "match": index.match_cache.stats(),
+        "search": index.search_cache.stats(),
+    }
+
+#load the index at module load time
+_index = _Index(_db_version())
 
 def fuzzy_ratio(a, b):
     """
     Calculate fuzzy string similarity ratio between two strings using SequenceMatcher.
-    Results are cached in a dictionary to avoid redundant comparisons.
+    Results are cached in a bounded LRU cache to avoid redundant comparisons.
     
     Args:
         a (str): First string to compare
@@ -63,12 +372,13 @@ def fuzzy_ratio(a, b):
     key = (a.lower(), b.lower())
     
     # Check cache first
-    if key in _fuzzy_cache:
-        return _fuzzy_cache[key]
+    score = _fuzzy_cache.get(key, _MISSING)
+    if score is not _MISSING:
+        return score
 
     # Compute similarity score
     score = SequenceMatcher(None, key[0], key[1]).ratio()
-    _fuzzy_cache[key] = score
+    _fuzzy_cache.put(key, score)
     return score
 
 '''
@@ -96,20 +406,22 @@ def apply_adaptive_threshold(matches):
     return [m for m in matches if m["score"] >= threshold]
 '''
 
-def lexicon_fuzzy_match(word, base_threshold=0.3):
+def lexicon_fuzzy_match(word, base_threshold=0.3, index=None):
     """
     Perform matching of the word against the lexicon. if a direct match is found, return only that.
-    Otherwise, perform fuzzy matching against all lexicon entries and return the top 5 above threshold.
+    Otherwise, perform fuzzy matching against the closest lexicon entries and return the top 5 above threshold.
     uses caching to speed up repeated queries.
     Args:
         word (str): Input word to match (should be lowercased  before calling)
         base_threshold (float): Minimum score threshold for matches
+        index (_Index): The index to match against, the current one by default
         Returns:
         list: List of match dictionaries with 'word_id', 'word', and 'score' keys
         
     Performance considerations:
     - Exact match is done first for speed this is O(1) with a dict lookup
-    - Fuzzy matching is O(N) over the lexicon, but optimized with caching of results
+    - Fuzzy matching only scores a few dozen candidates picked from a bigram index built at load time,
+      plus any word whose shared-character upper bound could still reach the top 5, so results match a full scan
     -We could go further such as including close matches even when an exact match is found, but for now we prioritize speed
     -due to limited compute
     -This is a good trade off between speed and accuracy for most use cases
@@ -120,17 +432,19 @@ def lexicon_fuzzy_match(word, base_threshold=0.3):
     
     
     
+    index = index or _index
     matches = []
-    if word in _match_cache:
-        return _match_cache[word]
+    cached = index.match_cache.get(word)
+    if cached is not None:
+        return cached
     # 1. Exact match fast path
-    if word in _lexicon_dict:
-        r = _lexicon_dict[word] # get the row from the dict 
-        _match_cache[word] = [{
+    if word in index.lexicon_dict:
+        r = index.lexicon_dict[word] # get the row from the dict 
+        index.match_cache.put(word, [{
             "word_id": r["word_id"],    
             "word": r["word"],
             "score": 1.0
-        }]
+        }])
         return [{
             "word_id": r["word_id"],    
             "word": r["word"],
@@ -138,32 +452,183 @@ def lexicon_fuzzy_match(word, base_threshold=0.3):
         }]
     
 
-     # 2. Fuzzy matching for all lexicon words
-    for r in _lexicon:
-        lex_word = r["word"]
-        score = fuzzy_ratio(word, lex_word)
-
+    # 2. Score the words sharing the most bigrams with the query, relative to their length
+    scores = {}  # lexicon position -> similarity score
+    query_grams = _bigrams(word)
+    hits = [index.bigram_index[gram] for gram in query_grams if gram in index.bigram_index]
+    closest = []
+    if hits:
+        shared = np.bincount(np.concatenate(hits), minlength=len(index.lexicon))
+        found = np.nonzero(shared)[0]
+        similarity = shared[found] / (len(query_grams) + index.bigram_counts[found])
+        closest = found[np.argsort(-similarity, kind="stable")[:_FUZZY_CANDIDATES]].tolist()
+    for i in closest:
+        scores[i] = fuzzy_ratio(word, index.lexicon[i]["word"])
+
+    # 3. SequenceMatcher can never match more characters than two words have in
+    # common, so only words whose bound still reaches the current 5th best score
+    # can change the result. This keeps the top 5 identical to a full scan.
+    top = heapq.nlargest(5, scores.values())
+    floor = top[-1] if len(top) == 5 and top[-1] > base_threshold else base_threshold
+    common = np.minimum(index.char_matrix, _char_counts(word)).sum(axis=1)
+    bound = 2.0 * common / (index.word_lengths + len(word))
+    for i in np.nonzero(bound >= floor)[0].tolist():
+        if i not in scores:
+            scores[i] = fuzzy_ratio(word, index.lexicon[i]["word"])
+
+    for i, score in sorted(scores.items()):
         if score >= base_threshold:
+            r = index.lexicon[i]
             matches.append({
                 "word_id": r["word_id"],
                 "word": r["word"],   # return original form
                 "score": score
             })
 
-    # 3. Sort strongest matches first
+    # 4. Sort strongest matches first
     matches.sort(key=lambda x: x["score"], reverse=True)
-    _match_cache[word] = matches[:5]
+    index.match_cache.put(word, matches[:5])
     return matches[:5]  # return top 5 matches only
 
+#BM25 parameters and the extra weight per font step of a word's largest occurrence
+BM25_K1 = 1.2
+BM25_B = 0.75
+FONT_BOOST = 0.05
+
+def bm25(tf, df, doc_length, collection=None):
+    """Return the BM25 weight of a word that appears tf times in a document of
+    doc_length words and in df documents overall, with the collection
+    statistics of the current index by default."""
+    collection = collection or _index.collection
+    num_docs = collection["num_docs"]
+    idf = math.log(1.0 + (num_docs - df + 0.5) / (df + 0.5))
+    norm = 1.0 - BM25_B + BM25_B * doc_length / collection["avg_doc_length"]
+    return idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * norm)
+
+class _RankedResults(object):
+    """The scored pages of one query, kept as compact (doc_id, score) pairs and
+    ranked lazily: a heap holds the pages not ranked yet, and only as many of
+    them are popped as the pages asked for so far need. Shared between threads
+    through the search cache of an _Index."""
+
+    __slots__ = ("_heap", "_ranked", "_lock")
+
+    def __init__(self, scored):
+        self._heap = [(-score, doc_id) for doc_id, score in scored]
+        heapq.heapify(self._heap)
+        self._ranked = []  # (doc_id, score) in final order
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._ranked) + len(self._heap)
+
+    def page(self, page, per_page):
+        """Return the (doc_id, score) pairs of a 1-based page of results."""
+        offset = (page - 1) * per_page
+        with self._lock:
+            while len(self._ranked) < offset + per_page and self._heap:
+                neg_score, doc_id = heapq.heappop(self._heap)
+                self._ranked.append((doc_id, -neg_score))
+            return self._ranked[offset:offset + per_page]
+
+def _result_details(ranked, index):
+    """Turn (doc_id, score) pairs into the result dicts shown on the page."""
+    if not ranked:
+        return []
+    cur = get_connection(index.version).cursor()
+    placeholders = ",".join("?" * len(ranked))
+    if index.collection["documents"]:
+        cur.execute("""
+            SELECT doc_id, url, title, description, page_rank AS pr
+            FROM documents
+            WHERE doc_id IN (%s)
+        """ % placeholders, tuple(doc_id for doc_id, _ in ranked))
+    else:
+        cur.execute("""
+            SELECT
+                d.doc_id,
+                d.url,
+                d.title,
+                d.description,
+                COALESCE(p.page_rank, 0.0) AS pr
+            FROM doc_index AS d
+            LEFT JOIN page_rank p ON p.doc_id = d.doc_id
+            WHERE d.doc_id IN (%s)
+        """ % placeholders, tuple(doc_id for doc_id, _ in ranked))
+    rows = {r["doc_id"]: r for r in cur.fetchall()}
+
+    results = []
+    for doc_id, score in ranked:
+        r = rows.get(doc_id)
+        if r is None:
+            continue # ranked on an index the database has been rebuilt from under
+        results.append({
+            "title": r["title"] or r["url"],
+            "url": r["url"],
+            "desc": (r["description"] or "").split("\n")[0][:250],
+            "page_rank": r["pr"],
+            "final_score": score,
+        })
+    return results
+
+def _fetch_candidates(word_ids, index):
+    """Yield (doc_id, page_rank, length, [(word_id, tf, max_font), ...]) once for
+    every page containing one of the words, from the segment file if there is
+    one and from the inverted_index table otherwise."""
+    if index.segment is not None:
+        terms_by_doc = defaultdict(list)
+        for word_id in word_ids:
+            for doc_id, tf, max_font, _, _ in index.segment.postings(word_id):
+                terms_by_doc[doc_id].append((word_id, tf, max_font))
+        for doc_id in sorted(terms_by_doc):
+            yield doc_id, float(index.doc_ranks[doc_id]), int(index.doc_lengths[doc_id]), terms_by_doc[doc_id]
+        return
+
+    if index.collection["postings_stats"]:
+        terms = "ii.word_id || ':' || ii.tf || ':' || ii.max_font"
+    else:
+        terms = "ii.word_id || ':1:0'"
+    placeholders = ",".join("?" * len(word_ids))
+    cur = get_connection(index.version).cursor()
+    if index.collection["documents"]:
+        cur.execute("""
+            SELECT ii.doc_id, d.page_rank AS pr, d.length, group_concat(%s) AS terms
+            FROM inverted_index AS ii
+            JOIN documents d ON d.doc_id = ii.doc_id
+            WHERE ii.word_id IN (%s)
+            GROUP BY ii.doc_id
+        """ % (terms, placeholders), tuple(word_ids))
+    else:
+        cur.execute("""
+            SELECT 
+                ii.doc_id,
+                COALESCE(p.page_rank, 0.0) AS pr,
+                %s AS length,
+                group_concat(%s) AS terms
+            FROM inverted_index AS ii
+            JOIN doc_index d ON d.doc_id = ii.doc_id
+            LEFT JOIN page_rank p ON p.doc_id = ii.doc_id
+            WHERE ii.word_id IN (%s)
+            GROUP BY ii.doc_id
+        """ % ("d.length" if index.collection["doc_lengths"] else "NULL", terms, placeholders), tuple(word_ids))
+    for r in cur:
+        yield r["doc_id"], r["pr"], r["length"], \
+            [tuple(int(v) for v in term.split(":")) for term in r["terms"].split(",")]
+
 def search_db(query: str, page: int, per_page: int = 5):
     """
     Fuzzy + PageRank search.
     Uses lexicon_fuzzy_match() to map query tokens to lexicon entries,
     then uses inverted_index → pages, and scores pages using:
        final_score = 0.65 * query_score + 0.35 * page_rank
+    where query_score adds up fuzzy score * BM25 * font boost over the matching words.
+    Only the requested page is ranked and looked up; the scores of the other
+    pages stay in the index's search cache until a later page is asked for.
     """
-    if query in _search_cache:
-        return _search_cache[query][ (page - 1) * per_page : page * per_page ]
+    index = refresh_index()
+    cached = index.search_cache.get(query)
+    if cached is not None:
+        return _result_details(cached.page(page, per_page), index)
 
     if not os.path.exists(DB_PATH):
         return []
@@ -176,7 +641,7 @@ def search_db(query: str, page: int, per_page: int = 5):
     #Collect fuzzy lexicon hits for every token ---
     lex_hits = []
     for tok in tokens:
-        lex_hits.extend(lexicon_fuzzy_match(tok))
+        lex_hits.extend(lexicon_fuzzy_match(tok, index=index))
 
     if not lex_hits:
         return []
@@ -195,102 +660,90 @@ def search_db(query: str, page: int, per_page: int = 5):
     word_scores = top_word_scores
 
 
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-
-    # Aggregate page hits from inverted index ---
-    page_scores = {}  # doc_id → combined scoring info
-
-    for word_id, q_score in word_scores.items():
-        cur.execute("""
-            SELECT 
-                d.doc_id,
-                d.url,
-                d.title,
-                d.description,
-                COALESCE(p.page_rank, 0.0) AS pr
-            FROM inverted_index AS ii
-            JOIN doc_index d ON d.doc_id = ii.doc_id
-            LEFT JOIN page_rank p ON p.doc_id = ii.doc_id
-            WHERE ii.word_id = ?
-        """, (word_id,))
-
-        for r in cur.fetchall():
-            doc_id = r["doc_id"]
-
-            if doc_id not in page_scores:
-                page_scores[doc_id] = {
-                    "title": r["title"] or r["url"],
-                    "url": r["url"],
-                    "desc": (r["description"] or "").split("\n")[0][:250],
-                    "page_rank": r["pr"],
-                    "query_score": 0.0,
-                    "hits": 0,
-                }
-
-            # Accumulate relevance
-            page_scores[doc_id]["query_score"] += q_score
-            page_scores[doc_id]["hits"] += 1
-
-    conn.close()
-
     #Compute final ranking score
-    for info in page_scores.values():
-        qs = info["query_score"]
-        pr = info["page_rank"]
-        hits = info["hits"]
+    scored = []  # (doc_id, final score)
+    for doc_id, pr, doc_length, terms in _fetch_candidates(word_scores, index):
+        doc_length = doc_length or index.collection["avg_doc_length"]
+        qs = 0.0
+        hits = 0
+        for word_id, tf, max_font in terms:
+            # relevance accumulated over the matching words
+            qs += word_scores[word_id] * bm25(tf, index.doc_freq.get(word_id, 1), doc_length, index.collection) \
+                * (1 + FONT_BOOST * max(max_font, 0))
+            hits += 1
 
         # small boost for pages matching multiple lexicon words
         coverage_boost = 1 + 0.1 * min(hits, 5)
 
-        info["final_score"] = coverage_boost * (0.65 * qs + 0.35 * pr)
+        scored.append((doc_id, coverage_boost * (0.65 * qs + 0.35 * pr)))
 
-    #Sort by final score
-    sorted_pages = sorted(
-        page_scores.values(),
-        key=lambda x: x["final_score"],
-        reverse=True
-    )
-    _search_cache[query] = sorted_pages
+    ranked = _RankedResults(scored)
+    index.search_cache.put(query, ranked)
     #pagination
-    offset = (page - 1) * per_page
-    return sorted_pages[offset:offset + per_page]
+    return _result_details(ranked.page(page, per_page), index)
 
 
 def search_db_simple(first_word: str, page: int, per_page: int = 5):
     """Return (results, total_count) for first_word, ordered by PageRank desc."""
     if not os.path.exists(DB_PATH):
         return []
+    index = refresh_index()
 
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
+    cur = get_connection(index.version).cursor()
 
     # Find word_id in lexicon
     cur.execute("SELECT word_id FROM lexicon WHERE word = ?", (first_word.lower(),))
     row = cur.fetchone()
     if not row:
-        conn.close()
         return []
     word_id = row["word_id"]
 
     # fetch page of results sorted by pagerank
     offset = (page - 1) * per_page
-    cur.execute("""
-        SELECT d.url,
-               d.title,
-               d.description,
-               COALESCE(p.page_rank, 0.0) AS pr
-        FROM inverted_index AS ii
-        JOIN doc_index      AS d ON d.doc_id = ii.doc_id
-        LEFT JOIN page_rank AS p ON p.doc_id = ii.doc_id
-        WHERE ii.word_id = ?
-        ORDER BY pr DESC
-        LIMIT ? OFFSET ?;
-    """, (word_id, per_page, offset))
-    rows = cur.fetchall()
-    conn.close()
+    if index.collection["ranked_postings"]:
+        # the postings are stored in page rank order, so this reads one range of them
+        cur.execute("""
+            SELECT d.url, d.title, d.description, d.page_rank AS pr
+            FROM ranked_postings AS rp
+            JOIN documents AS d ON d.doc_id = rp.doc_id
+            WHERE rp.word_id = ?
+            ORDER BY rp.rank
+            LIMIT ? OFFSET ?
+        """, (word_id, per_page, offset))
+        rows = cur.fetchall()
+    elif index.segment is not None:
+        doc_ids = np.fromiter((p[0] for p in index.segment.postings(word_id)), dtype=np.int64)
+        # stable sort keeps doc_id order between pages with the same rank
+        page_ids = doc_ids[np.argsort(-index.doc_ranks[doc_ids], kind="stable")[offset:offset + per_page]].tolist()
+        if index.collection["documents"]:
+            cur.execute("""
+                SELECT doc_id, url, title, description, page_rank AS pr
+                FROM documents
+                WHERE doc_id IN (%s)
+            """ % ",".join("?" * len(page_ids)), page_ids)
+        else:
+            cur.execute("""
+                SELECT d.doc_id, d.url, d.title, d.description, COALESCE(p.page_rank, 0.0) AS pr
+                FROM doc_index AS d
+                LEFT JOIN page_rank AS p ON p.doc_id = d.doc_id
+                WHERE d.doc_id IN (%s)
+            """ % ",".join("?" * len(page_ids)), page_ids)
+        by_id = {r["doc_id"]: r for r in cur.fetchall()}
+        rows = [by_id[doc_id] for doc_id in page_ids if doc_id in by_id]
+    else:
+        cur.execute("""
+            SELECT d.url,
+                   d.title,
+                   d.description,
+                   COALESCE(p.page_rank, 0.0) AS pr
+            FROM inverted_index AS ii
+            JOIN doc_index      AS d ON d.doc_id = ii.doc_id
+            LEFT JOIN page_rank AS p ON p.doc_id = ii.doc_id
+            WHERE ii.word_id = ?
+            ORDER BY pr DESC
+            LIMIT ? OFFSET ?;
+        """, (word_id, per_page, offset))
+        rows = cur.fetchall()
 
     ## format into list of dictionaries
     results = []
@@ -306,16 +759,12 @@ def search_db_simple(first_word: str, page: int, per_page: int = 5):
 
 def getAllKnownWords():
     """Return a list of all known words in the database."""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
+    cur = get_connection().cursor()
 
     # Find words in lexicon
     cur.execute("SELECT word FROM lexicon")
     rows = cur.fetchall()
 
-    conn.close()
-
     # format into a list
     result = []
 
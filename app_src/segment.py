@@ -0,0 +1,116 @@
+"""An alternative on-disk format for the inverted index: one segment file.
+
+    header      magic, number of terms, version (a hash of the rest of the file)
+    dictionary  one fixed size entry per term, sorted by word_id:
+                word_id, offset of its postings, document frequency, size in bytes
+    postings    for every document of a term, in doc_id order, as varints:
+                doc_id delta, tf, zigzag(max_font), zigzag(sum_font),
+                size of the positions followed by the delta encoded positions
+
+The dictionary is binary searched directly in the memory map and postings are
+decoded from memoryview slices of it, so nothing is copied out of the file."""
+
+import hashlib
+import mmap
+import struct
+
+from postings import encode_varint, decode_varint, zigzag, unzigzag
+
+_MAGIC = b"GOFSEG02"
+_HEADER = struct.Struct("<8sIQ")
+_ENTRY = struct.Struct("<IQII")
+
+
+def write_segment(path, terms):
+    """Write a segment file.
+
+    terms is an iterable of (word_id, postings) in increasing word_id order,
+    where postings is a list of (doc_id, tf, max_font, sum_font, positions)
+    sorted by doc_id and positions is already encoded with encode_positions().
+
+    Returns the version of the file, which the database built with it records,
+    so a reader can tell whether the two belong together. To replace a segment
+    that readers may have mapped, write the new one next to it and move it over."""
+    entries = []
+    blob = bytearray()
+    for word_id, postings in terms:
+        start = len(blob)
+        prev = 0
+        for doc_id, tf, max_font, sum_font, positions in postings:
+            encode_varint(doc_id - prev, blob)
+            encode_varint(tf, blob)
+            encode_varint(zigzag(max_font), blob)
+            encode_varint(zigzag(sum_font), blob)
+            encode_varint(len(positions), blob)
+            blob += positions
+            prev = doc_id
+        entries.append((word_id, start, len(postings), len(blob) - start))
+
+    postings_start = _HEADER.size + len(entries) * _ENTRY.size
+    dictionary = b"".join(_ENTRY.pack(word_id, postings_start + start, df, size)
+                          for word_id, start, df, size in entries)
+    digest = hashlib.blake2b(dictionary, digest_size=8)
+    digest.update(blob)
+    version = int.from_bytes(digest.digest(), "little") >> 1 # fits an SQLite INTEGER
+    with open(path, "wb") as f:
+        f.write(_HEADER.pack(_MAGIC, len(entries), version))
+        f.write(dictionary)
+        f.write(blob)
+    return version
+
+
+class SegmentReader(object):
+    """Read-only access to a segment file through a shared memory map."""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+        magic, self.num_terms, self.version = _HEADER.unpack_from(self._view, 0)
+        if magic != _MAGIC:
+            raise ValueError("%s is not a segment file" % path)
+
+    def _find(self, word_id):
+        """Binary search the dictionary. Returns (offset, df, size) or None."""
+        lo, hi = 0, self.num_terms
+        while lo < hi:
+            mid = (lo + hi) // 2
+            entry_id, offset, df, size = _ENTRY.unpack_from(self._view, _HEADER.size + mid * _ENTRY.size)
+            if entry_id < word_id:
+                lo = mid + 1
+            elif entry_id > word_id:
+                hi = mid
+            else:
+                return offset, df, size
+        return None
+
+    def doc_freq(self, word_id):
+        """Return the number of documents a word appears in."""
+        entry = self._find(word_id)
+        return entry[1] if entry else 0
+
+    def postings(self, word_id):
+        """Yield (doc_id, tf, max_font, sum_font, positions) for every document
+        containing the word. positions is a memoryview of the encoded positions,
+        decode it with decode_positions() if needed."""
+        entry = self._find(word_id)
+        if entry is None:
+            return
+        offset, df, size = entry
+        buf = self._view[offset:offset + size]
+        pos = 0
+        doc_id = 0
+        for _ in range(df):
+            delta, pos = decode_varint(buf, pos)
+            tf, pos = decode_varint(buf, pos)
+            max_font, pos = decode_varint(buf, pos)
+            sum_font, pos = decode_varint(buf, pos)
+            length, pos = decode_varint(buf, pos)
+            doc_id += delta
+            yield doc_id, tf, unzigzag(max_font), unzigzag(sum_font), buf[pos:pos + length]
+            pos += length
+
+    def close(self):
+        """Unmap the file. Any positions returned by postings() must be released first."""
+        self._view.release()
+        self._mmap.close()
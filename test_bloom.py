@@ -0,0 +1,24 @@
+import unittest
+from bloom import BloomFilter, ScalableBloomFilter
+
+# python -m unittest test_bloom.py
+
+class TestBloom(unittest.TestCase):
+    def test_no_false_negatives(self):
+        bloom = BloomFilter(1000, 0.01)
+        for i in range(1000):
+            bloom.add("http://site.test/%d" % i)
+        self.assertTrue(all("http://site.test/%d" % i in bloom for i in range(1000)))
+
+    def test_scalable_filter_grows_and_keeps_error_rate(self):
+        bloom = ScalableBloomFilter(initial_capacity=100, error_rate=0.01)
+        added = [bloom.add("http://site.test/%d" % i) for i in range(5000)]
+        self.assertGreater(sum(added), 4900, "new keys should almost always be reported as new")
+        self.assertFalse(bloom.add("http://site.test/1"), "a key added before is never reported as new")
+        self.assertGreater(len(bloom._filters), 1)
+
+        false_positives = sum("http://other.test/%d" % i in bloom for i in range(10000))
+        self.assertLess(false_positives / 10000, 0.02)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,44 @@
+import unittest
+from unittest import mock
+from cache import LRUCache
+
+# python -m unittest test_cache.py
+
+class TestLRUCache(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(maxsize=2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.get("a")  # "b" is now the least recently used entry
+        cache.put("c", 3)
+
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"), "least recently used entry should be evicted")
+        self.assertEqual(cache.get("c"), 3)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_entries_expire_after_ttl(self):
+        cache = LRUCache(maxsize=10, ttl=5)
+        with mock.patch("cache.time.monotonic", return_value=100.0):
+            cache.put("query", ["result"])
+        with mock.patch("cache.time.monotonic", return_value=104.0):
+            self.assertEqual(cache.get("query"), ["result"])
+        with mock.patch("cache.time.monotonic", return_value=105.0):
+            self.assertIsNone(cache.get("query"), "entry should expire after ttl seconds")
+
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["expirations"]), (1, 1, 1))
+
+    def test_clear_keeps_counters(self):
+        cache = LRUCache(maxsize=10)
+        cache.put("a", 1)
+        cache.get("a")
+        cache.clear()
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["size"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,5 +1,8 @@
 import unittest
-from crawler import crawler
+from crawler import crawler, host_scheduler, canonicalize_url, shard_of
+from postings import decode_positions
+from segment import SegmentReader
+from frontier import SQLiteFrontier
 from bs4 import BeautifulSoup, Tag
 import requests
 
@@ -196,6 +199,498 @@ class TestCrawler(unittest.TestCase):
         self.assertGreater(pr2, pr1, "Node 2 should have higher PR than Node 1")
         self.assertGreater(pr3, pr2, "Node 3 should have higher PR than Node 2")
 
+    def crawl_fake_site(self, bot, num_workers, streaming=True, num_parsers=0):
+        # serve a small linked site from memory instead of the network
+        pages = {
+            "http://site.test/": '<html><head><title>Home</title></head><body><h1>welcome</h1>'
+                                 '<a href="http://site.test/one">one</a><a href="http://site.test/two">two</a></body></html>',
+            "http://site.test/one": '<html><body><p>first page</p><a href="http://site.test/">home</a></body></html>',
+            "http://site.test/two": '<html><body><p>second page</p><a href="http://site.test/one">one</a></body></html>',
+        }
+        bot._fetch = lambda url, timeout, validators=None: pages[url].encode()
+        bot._url_queue = [("http://site.test/", 0)]
+        bot.crawl(depth=2, num_workers=num_workers, streaming=streaming, num_parsers=num_parsers)
+        return bot.get_resolved_inverted_index()
+
+    def test_parse_processes_match_inline_parsing(self):
+        inline = self.crawl_fake_site(self.bot, num_workers=1)
+        bot = crawler(None, "empty.txt")
+        parsed = self.crawl_fake_site(bot, num_workers=1, num_parsers=2)
+
+        self.assertEqual(parsed, inline)
+        self.assertEqual(bot.get_links(), self.bot.get_links())
+        for doc_id, info in self.bot._doc_index.items():
+            self.assertEqual(bot._doc_index[doc_id], info)
+        word_id = bot.word_id("welcome")
+        self.assertEqual(list(bot._postings[word_id].items()), list(self.bot._postings[word_id].items()))
+
+    def test_crawl_concurrent_matches_sequential(self):
+        sequential = self.crawl_fake_site(self.bot, num_workers=1)
+        concurrent = self.crawl_fake_site(crawler(None, "empty.txt"), num_workers=4)
+
+        self.assertEqual(len(self.bot._doc_index), 3, "all three pages should be indexed")
+        self.assertEqual(concurrent, sequential, "worker count should not change the index")
+        self.assertEqual(concurrent["page"], {"http://site.test/one", "http://site.test/two"})
+
+    def test_streaming_index_matches_tree_walk(self):
+        tree = self.crawl_fake_site(self.bot, num_workers=1, streaming=False)
+        streaming_bot = crawler(None, "empty.txt")
+        streamed = self.crawl_fake_site(streaming_bot, num_workers=1, streaming=True)
+
+        self.assertEqual(streamed, tree, "both indexing modes should find the same words")
+        self.assertEqual(streaming_bot._links, self.bot._links, "both indexing modes should find the same links")
+        for doc_id, info in self.bot._doc_index.items():
+            self.assertEqual(streaming_bot._doc_index[doc_id], info)
+
+    def test_streaming_index_skips_ignored_tags(self):
+        self.bot._fetch = lambda url, timeout, validators=None: (
+            b'<html><head><title>Big Title</title><script>var hidden = "<p>";</script></head>'
+            b'<body><svg><text>vector</text></svg><p>line one<br>still one</p>\n<p>line two</p>'
+            b'<img src="x.png"><h1>header &amp; more</h1><p>line four</p></body></html>')
+        self.bot._url_queue = [("http://site.test/", 0)]
+        self.bot.crawl(depth=0)
+
+        words = set(self.bot.get_resolved_inverted_index())
+        self.assertIn("header", words)
+        self.assertNotIn("hidden", words, "script contents should not be indexed")
+        self.assertNotIn("vector", words, "svg contents should not be indexed")
+        doc = self.bot._doc_index[1]
+        self.assertEqual(doc["title"], "Big Title")
+        self.assertEqual(doc["description"], ["line one", "still one", "line two"])
+
+    def test_postings_record_frequency_font_and_positions(self):
+        self.bot._fetch = lambda url, timeout, validators=None: b'<html><body><h1>big word</h1><p>word <b>word</b></p></body></html>'
+        self.bot._url_queue = [("http://site.test/", 0)]
+        self.bot.crawl(depth=0)
+
+        word_id = self.bot.word_id("word")
+        tf, max_font, sum_font, positions = self.bot._postings[word_id][1]
+        self.assertEqual(tf, 3)
+        self.assertEqual(max_font, 7, "h1 text should have the largest font size")
+        self.assertEqual(sum_font, 7 + 0 + 2)
+        self.assertEqual(list(positions), [1, 2, 3])
+        self.assertEqual(self.bot._doc_index[1]["length"], 4)
+
+        # positions survive the round trip through the database
+        self.bot.store_to_database()
+        import sqlite3
+        conn = sqlite3.connect("search_engine.db")
+        row = conn.execute("SELECT tf, max_font, positions FROM inverted_index WHERE word_id = ?", (word_id,)).fetchone()
+        conn.close()
+        self.assertEqual((row[0], row[1], decode_positions(row[2])), (3, 7, [1, 2, 3]))
+
+    def test_store_to_database_bulk_load(self):
+        self.crawl_fake_site(self.bot, num_workers=2)
+        self.bot.compute_page_rank()
+        self.bot.store_to_database()
+        self.assert_db_populated()
+
+        # storing twice rebuilds the tables instead of piling up rows
+        self.bot.store_to_database()
+        import sqlite3
+        conn = sqlite3.connect("search_engine.db")
+        postings = conn.execute("SELECT COUNT(*) FROM inverted_index").fetchone()[0]
+        conn.close()
+        self.assertEqual(postings, sum(len(docs) for docs in self.bot._inverted_index.values()))
+
+    def test_store_documents_in_page_rank_order(self):
+        import sqlite3
+        self.crawl_fake_site(self.bot, num_workers=1)
+        self.bot.compute_page_rank()
+        self.bot.store_to_database()
+
+        conn = sqlite3.connect("search_engine.db")
+        documents = {r[0]: r[1:] for r in conn.execute("SELECT doc_id, url, title, description, page_rank FROM documents")}
+        self.assertEqual(documents[1], ("http://site.test/", "Home", "welcome", self.bot._page_rank[1]))
+        word_id = self.bot.word_id("page")
+        ranked = [r[0] for r in conn.execute("SELECT doc_id FROM ranked_postings WHERE word_id = ? ORDER BY rank", (word_id,))]
+        conn.close()
+        self.assertEqual(ranked, sorted(self.bot._inverted_index[word_id], key=lambda d: -self.bot._page_rank[d]))
+
+    def test_store_segment_backend(self):
+        import os
+        import sqlite3
+        self.crawl_fake_site(self.bot, num_workers=1)
+        self.bot.compute_page_rank()
+        self.bot.store_to_database(backend="segment")
+        self.addCleanup(os.remove, "search_engine.seg")
+
+        reader = SegmentReader("search_engine.seg")
+        self.assertEqual(reader.num_terms, len(self.bot._inverted_index))
+        for word_id, docs in self.bot._inverted_index.items():
+            self.assertEqual(reader.doc_freq(word_id), len(docs))
+            for doc_id, tf, max_font, sum_font, positions in reader.postings(word_id):
+                self.assertEqual((tf, max_font, sum_font, decode_positions(positions)),
+                                 tuple(self.bot._postings[word_id][doc_id][:3]) +
+                                 (list(self.bot._postings[word_id][doc_id][3]),))
+        self.assertEqual(list(reader.postings(max(self.bot._inverted_index) + 1)), [])
+        del positions
+        reader.close()
+
+        # the postings are only kept in the segment file
+        conn = sqlite3.connect("search_engine.db")
+        tables = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        rows = {table: conn.execute("SELECT COUNT(*) FROM %s" % table).fetchone()[0] for table in tables}
+        conn.close()
+        self.assertNotIn("inverted_index", tables)
+        self.assertNotIn("ranked_postings", tables)
+        self.assertIn("doc_index", tables)
+        num_postings = sum(len(docs) for docs in self.bot._inverted_index.values())
+        self.assertTrue(all(count < num_postings for count in rows.values()), "no table has a row per posting")
+
+    def test_incremental_recrawl_only_reindexes_changed_pages(self):
+        pages = {
+            "http://site.test/": b'<html><body><p>home page</p><a href="http://site.test/one">one</a>'
+                                 b'<a href="http://site.test/two">two</a></body></html>',
+            "http://site.test/one": b'<html><body><p>first page</p><a href="http://site.test/three">three</a></body></html>',
+            "http://site.test/two": b'<html><body><p>second page</p></body></html>',
+            "http://site.test/three": b'<html><body><p>third page</p></body></html>',
+        }
+
+        def fetch(url, timeout, validators=None):
+            # the home page supports conditional requests, the others are compared by hash
+            if url == "http://site.test/":
+                if validators.get("etag") == '"v1"':
+                    return None
+                validators["etag"] = '"v1"'
+            return pages[url]
+
+        self.bot._fetch = fetch
+        self.bot._url_queue = [("http://site.test/", 0)]
+        self.bot.crawl(depth=2)
+        self.bot.compute_page_rank()
+        self.bot.store_to_database()
+
+        pages["http://site.test/two"] = b'<html><body><p>second page changed</p></body></html>'
+        bot = crawler(None, "empty.txt")
+        bot.load_from_database()
+        indexed = []
+        index_page = bot._index_page_streaming
+        bot._index_page_streaming = lambda url, *args: indexed.append(url) or index_page(url, *args)
+        bot._fetch = fetch
+        bot._url_queue = [("http://site.test/", 0)]
+        bot.crawl(depth=2)
+
+        self.assertEqual(indexed, ["http://site.test/two"], "only the changed page should be indexed again")
+        resolved = bot.get_resolved_inverted_index()
+        self.assertEqual(resolved["changed"], {"http://site.test/two"})
+        self.assertEqual(resolved["page"], set(pages))
+        self.assertEqual(bot._links, self.bot._links)
+        self.assertEqual(bot._doc_index[1]["etag"], '"v1"')
+        # new words get ids after the stored ones
+        self.assertEqual(bot.word_id("changed"), max(self.bot._lexicon) + 1)
+
+    def test_crawl_resumes_after_crash(self):
+        import os
+        import shutil
+        import tempfile
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        path = os.path.join(tmp, "frontier.db")
+        pages = {
+            "http://site.test/": b'<html><body><p>home</p><a href="http://site.test/one">one</a>'
+                                 b'<a href="http://site.test/two">two</a></body></html>',
+            "http://site.test/one": b'<html><body><p>first</p><a href="http://site.test/three">three</a></body></html>',
+            "http://site.test/two": b'<html><body><p>second</p></body></html>',
+            "http://site.test/three": b'<html><body><p>third</p></body></html>',
+        }
+        fetched = []
+
+        def fetch(url, timeout, validators=None):
+            fetched.append(url)
+            if url == "http://site.test/three" and len(fetched) == 4:
+                raise KeyboardInterrupt  # the crawl dies before the last page
+            return pages[url]
+
+        frontier = SQLiteFrontier(path)
+        bot = crawler(None, "empty.txt", frontier=frontier)
+        bot._fetch = fetch
+        bot._url_queue = [("http://site.test/", 0)]
+        with self.assertRaises(KeyboardInterrupt):
+            bot.crawl(depth=2, checkpoint_every=1)
+        frontier.close()
+
+        del fetched[:]
+        frontier = SQLiteFrontier(path)
+        bot = crawler(None, "empty.txt", frontier=frontier)
+        bot.load_from_database()
+        bot._fetch = fetch
+        bot.crawl(depth=2)
+        frontier.close()
+        self.assertEqual(fetched, ["http://site.test/three"], "pages from before the crash are not fetched again")
+
+        self.bot._fetch = lambda url, timeout, validators=None: pages[url]
+        self.bot._url_queue = [("http://site.test/", 0)]
+        self.bot.crawl(depth=2)
+        self.assertEqual(bot.get_resolved_inverted_index(), self.bot.get_resolved_inverted_index())
+
+    def test_checkpoints_store_a_linear_amount_overall(self):
+        num_pages = 300
+        pages = {"http://site.test/%d" % i: ('<html><body><p>page %d</p><a href="http://site.test/%d">next</a>'
+                                             '</body></html>' % (i, i + 1)).encode() for i in range(num_pages)}
+        stored = [] # index size at every checkpoint, which rewrites all of it
+        self.bot.checkpoint = lambda backend="sqlite": stored.append(len(self.bot._doc_index))
+        self.bot._fetch = lambda url, timeout, validators=None: pages[url]
+        self.bot._url_queue = [("http://site.test/0", 0)]
+        self.bot.crawl(depth=num_pages - 1, checkpoint_every=10)
+
+        self.assertEqual(len(self.bot._doc_index), num_pages)
+        self.assertEqual(stored[:3], [10, 20, 30], "small crawls checkpoint every checkpoint_every pages")
+        self.assertLessEqual(sum(stored), 4 * num_pages)
+
+    def test_sharded_build_merges_into_one_index(self):
+        import os
+        import shutil
+        import tempfile
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        pages = {
+            "http://news.test/": b'<html><head><title>News</title></head><body><p>daily news page</p>'
+                                 b'<a href="http://news.test/sports">sports</a><a href="http://docs.test/">docs</a></body></html>',
+            "http://news.test/sports": b'<html><body><h1>sports news</h1><a href="http://docs.test/api">api</a></body></html>',
+            "http://docs.test/": b'<html><body><p>docs page</p><a href="http://docs.test/api">api</a>'
+                                 b'<a href="http://news.test/">news</a></body></html>',
+            "http://docs.test/api": b'<html><body><p>api docs</p><b>page</b></body></html>',
+        }
+        self.assertNotEqual(shard_of("http://news.test/", 2), shard_of("http://docs.test/", 2))
+        seeds = [("http://news.test/", 0), ("http://docs.test/", 0)]
+
+        shard_files = []
+        for index in range(2):
+            shard_file = os.path.join(tmp, "shard%d.db" % index)
+            bot = crawler(None, "empty.txt", shard=(index, 2), db_file=shard_file)
+            bot._fetch = lambda url, timeout, validators=None: pages[url]
+            bot._url_queue = list(seeds)
+            bot.crawl(depth=2)
+            self.assertEqual({shard_of(info["url"], 2) for info in bot._doc_index.values()}, {index},
+                             "a shard only crawls its own hosts")
+            bot.store_to_database(backend="segment" if index else "sqlite")
+            shard_files.append(shard_file)
+
+        merged = crawler(None, "empty.txt", db_file=os.path.join(tmp, "merged.db"))
+        for shard_file in shard_files:
+            merged.merge_from_database(shard_file)
+        self.bot._fetch = lambda url, timeout, validators=None: pages[url]
+        self.bot._url_queue = list(seeds)
+        self.bot.crawl(depth=2)
+
+        self.assertEqual(merged.get_resolved_inverted_index(), self.bot.get_resolved_inverted_index())
+        self.assertEqual(merged.get_links(), self.bot.get_links())
+        page = self.bot.word_id("page")
+        self.assertEqual({self.bot._doc_index[doc_id]["url"]: posting for doc_id, posting in self.bot._postings[page].items()},
+                         {merged._doc_index[doc_id]["url"]: posting for doc_id, posting in merged._postings[merged.word_id("page")].items()})
+        self.assertEqual(sorted(merged._lexicon.values()), sorted(self.bot._lexicon.values()))
+
+        merged.compute_page_rank()
+        merged.store_to_database()
+        reloaded = crawler(None, "empty.txt", db_file=os.path.join(tmp, "merged.db"))
+        reloaded.load_from_database()
+        self.assertEqual(reloaded.get_resolved_inverted_index(), self.bot.get_resolved_inverted_index())
+
+    def test_host_scheduler_limits_and_interleaves_hosts(self):
+        scheduler = host_scheduler(max_per_host=1, delay=1.0)
+        scheduler.started("slow.test", 0.0)
+        self.assertFalse(scheduler.ready("slow.test", 0.5), "one request at a time per host")
+        for url in ("http://slow.test/1", "http://slow.test/2", "http://fast.test/1"):
+            scheduler.defer(url, 0)
+
+        # the fast host is served while the slow one is still busy
+        self.assertEqual(scheduler.next_ready(0.5), ("http://fast.test/1", 0))
+        self.assertIsNone(scheduler.next_ready(0.5))
+        self.assertIsNone(scheduler.next_wakeup(), "a busy host waits for its request, not for a time")
+
+        scheduler.finished("slow.test")
+        self.assertIsNone(scheduler.next_ready(0.5), "the slow host is still in its delay")
+        self.assertEqual(scheduler.next_wakeup(), 1.0)
+        self.assertEqual(scheduler.next_ready(1.0), ("http://slow.test/1", 0))
+        scheduler.started("slow.test", 1.0)
+        scheduler.finished("slow.test")
+        scheduler.set_delay("slow.test", 5.0)
+        scheduler.started("slow.test", 2.0)
+        scheduler.finished("slow.test")
+        self.assertIsNone(scheduler.next_ready(6.0), "a robots.txt crawl delay overrides the default delay")
+        self.assertEqual(scheduler.next_ready(7.0), ("http://slow.test/2", 0))
+        self.assertEqual(scheduler.num_waiting, 0)
+
+    def test_crawl_waits_for_a_busy_host_without_spinning(self):
+        import time
+        def fetch(url, timeout, validators=None):
+            time.sleep(0.2)
+            return ('<html><body>%s</body></html>' % "".join(
+                '<a href="http://site.test/%d">x</a>' % i for i in range(4))).encode()
+        self.bot._fetch = fetch
+        self.bot._url_queue = [("http://site.test/", 0)]
+        # the crawl loop moves the urls found into the frontier once per turn
+        turns = []
+        queue_found_urls = self.bot._queue_found_urls
+        self.bot._queue_found_urls = lambda depth: turns.append(depth) or queue_found_urls(depth)
+        self.bot.crawl(depth=1, num_workers=4, max_per_host=1)
+
+        self.assertEqual(len(self.bot._doc_index), 5)
+        self.assertLess(len(turns), 20, "the crawl should sleep while the host is at its limit")
+
+    def test_fetch_obeys_robots_and_conditional_requests(self):
+        import threading
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        requests_seen = []
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                requests_seen.append(self.path)
+                if self.path == "/robots.txt":
+                    body = b"User-agent: *\nDisallow: /private\n"
+                elif self.headers.get("If-None-Match") == '"v1"':
+                    self.send_response(304)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                else:
+                    body = (b'<html><body><p>public words</p><a href="/private">secret</a>'
+                            b'<a href="/other">other</a></body></html>')
+                self.send_response(200)
+                self.send_header("ETag", '"v1"')
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        root = "http://127.0.0.1:%d/" % server.server_port
+
+        self.bot._url_queue = [(root, 0)]
+        self.bot.crawl(depth=1, num_workers=2)
+        urls = {info["url"] for info in self.bot._doc_index.values()}
+        self.assertEqual(urls, {root, root + "other"}, "robots.txt disallows /private")
+        self.assertEqual(requests_seen.count("/robots.txt"), 1, "robots.txt is fetched once per host")
+        self.assertNotIn("/private", requests_seen)
+
+        validators = {"etag": '"v1"'}
+        self.assertIsNone(self.bot._fetch(root, 3, validators), "304 means the page was not modified")
+
+    def test_command_line_crawl_stores_page_ranks(self):
+        import os
+        import sqlite3
+        import subprocess
+        import sys
+        import tempfile
+        import threading
+        import crawler as crawler_module
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        pages = {
+            "/": b'<html><body><p>home</p><a href="/one">one</a><a href="/two">two</a></body></html>',
+            "/one": b'<html><body><p>first</p><a href="/">home</a></body></html>',
+            "/two": b'<html><body><p>second</p><a href="/one">one</a></body></html>',
+        }
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = pages.get(self.path)
+                self.send_response(200 if body else 404)
+                self.send_header("Content-Length", str(len(body or b"")))
+                self.end_headers()
+                self.wfile.write(body or b"")
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        with open(os.path.join(tmp.name, "urls.txt"), "w") as f:
+            f.write("http://127.0.0.1:%d/\n" % server.server_port)
+
+        for flags in ([], ["--incremental"], ["--backend", "segment"], ["--incremental", "--backend", "segment"]):
+            subprocess.run([sys.executable, crawler_module.__file__, "--parsers", "0"] + flags,
+                           cwd=tmp.name, check=True, capture_output=True)
+            conn = sqlite3.connect(os.path.join(tmp.name, "search_engine.db"))
+            ranks = [r[0] for r in conn.execute("SELECT page_rank FROM documents")]
+            stored = conn.execute("SELECT COUNT(*) FROM page_rank").fetchone()[0]
+            tables = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            conn.close()
+            self.assertEqual("inverted_index" not in tables, "segment" in flags, flags)
+            self.assertEqual(os.path.exists(os.path.join(tmp.name, "search_engine.seg")), "segment" in flags, flags)
+            self.assertEqual(len(ranks), 3)
+            self.assertEqual(stored, 3, "every crawled page should have a stored page rank")
+            self.assertTrue(all(rank > 0 for rank in ranks), flags)
+
+    def test_fetch_follows_redirect_chains(self):
+        import threading
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                hops = {"/r": "/r1", "/r1": "/r2", "/r2": "/final/page",
+                        "/loop0": "/loop1", "/loop1": "/loop2", "/loop2": "/loop3",
+                        "/loop3": "/loop4", "/loop4": "/loop5", "/loop5": "/loop6", "/loop6": "/final/page"}
+                if self.path in hops:
+                    self.send_response(302)
+                    self.send_header("Location", hops[self.path])
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                body = b'<html><body><p>arrived</p><a href="other">other</a></body></html>' \
+                    if self.path == "/final/page" else b"<html><body>other</body></html>"
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        root = "http://127.0.0.1:%d" % server.server_port
+
+        page = self.bot._fetch(root + "/r", 3)
+        self.assertIn(b"arrived", page, "three redirects are followed to the final page")
+        self.assertEqual(page.url, root + "/final/page")
+        with self.assertRaises(IOError):
+            self.bot._fetch(root + "/loop0", 3) # seven redirects
+
+        self.bot._url_queue = [(root + "/r", 0), (root + "/loop0", 0)]
+        self.bot.crawl(depth=1)
+        urls = {info["url"] for info in self.bot._doc_index.values()}
+        self.assertEqual(urls, {root + "/r", root + "/final/other"},
+                         "links resolve against the redirected url and too long a chain is not indexed")
+
+    def test_canonicalize_url(self):
+        self.assertEqual(canonicalize_url("HTTP://Site.TEST:80//a//b?utm_source=x&q=1&fbclid=2#top"),
+                         "http://site.test/a/b?q=1")
+        self.assertEqual(canonicalize_url("https://site.test:443"), "https://site.test/")
+        self.assertEqual(canonicalize_url("https://site.test:8443/dir/"), "https://site.test:8443/dir/")
+        self.assertEqual(canonicalize_url("mailto:someone@site.test"), "mailto:someone@site.test")
+
+    def test_repeated_links_are_queued_once(self):
+        html = (b'<html><body><a href="/a">a</a><a href="/a#top">a</a><a href="HTTP://SITE.TEST/a">a</a>'
+                b'<a href="/a?utm_campaign=x">a</a><a href="/b">b</a><a href="mailto:x@site.test">mail</a>'
+                b'<a href="/b">b</a></body></html>')
+        self.bot._url_queue = []
+        self.bot._max_depth = 1
+        self.bot._index_page_streaming("http://site.test/", 0, self.bot.document_id("http://site.test/"), html)
+        self.assertEqual(self.bot._url_queue, [("http://site.test/a", 1), ("http://site.test/b", 1)])
+        self.assertEqual(len(self.bot._links[1]), 3, "links are still recorded for PageRank")
+
+        # links past the depth limit are never queued
+        self.bot._url_queue = []
+        self.bot._index_page_streaming("http://site.test/b", 1, self.bot.document_id("http://site.test/b"),
+                                       b'<html><body><a href="/c">c</a></body></html>')
+        self.assertEqual(self.bot._url_queue, [])
+
     ## Lab 1+2 unit tests
     '''
     def test_crawl_example_com(self):
@@ -0,0 +1,61 @@
+import os
+import shutil
+import tempfile
+import unittest
+from frontier import MemoryFrontier, SQLiteFrontier
+
+# python -m unittest test_frontier.py
+
+class TestFrontier(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "frontier.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def frontiers(self):
+        yield MemoryFrontier()
+        frontier = SQLiteFrontier(self.path)
+        yield frontier
+        frontier.close()
+
+    def test_pops_shallowest_first_and_only_once(self):
+        for frontier in self.frontiers():
+            frontier.extend([("http://a/", 1), ("http://b/", 0), ("http://c/", 1)])
+            frontier.push("http://a/", 1)
+            self.assertEqual(len(frontier), 3)
+            self.assertEqual(frontier.pop(), ("http://b/", 0))
+            self.assertEqual(frontier.pop(), ("http://a/", 1), "equal depths come out in the order they went in")
+
+            frontier.push("http://b/", 0)
+            self.assertEqual(frontier.pop(), ("http://c/", 1), "urls already handed out are not queued again")
+            self.assertEqual(len(frontier), 0)
+            self.assertRaises(IndexError, frontier.pop)
+
+    def test_smaller_depth_moves_pending_url_up(self):
+        for frontier in self.frontiers():
+            frontier.extend([("http://a/", 0), ("http://deep/", 3), ("http://b/", 1)])
+            frontier.push("http://deep/", 1)
+            self.assertEqual(len(frontier), 3)
+            self.assertEqual([frontier.pop() for _ in range(3)],
+                             [("http://a/", 0), ("http://deep/", 1), ("http://b/", 1)])
+
+    def test_sqlite_frontier_resumes_from_last_commit(self):
+        frontier = SQLiteFrontier(self.path)
+        frontier.extend([("http://a/", 0), ("http://b/", 1), ("http://c/", 1)])
+        frontier.done(frontier.pop()[0])
+        frontier.commit()
+        frontier.pop()  # taken but never done
+        frontier.push("http://d/", 2)  # never committed
+        frontier.close()
+
+        frontier = SQLiteFrontier(self.path)
+        self.assertEqual(len(frontier), 2)
+        self.assertEqual([frontier.pop(), frontier.pop()], [("http://b/", 1), ("http://c/", 1)])
+        frontier.push("http://a/", 0)
+        self.assertEqual(len(frontier), 0, "done urls stay seen after a restart")
+        frontier.close()
+
+if __name__ == "__main__":
+    unittest.main()
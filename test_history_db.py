@@ -0,0 +1,72 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+import history_db
+
+# python -m unittest test_history_db.py
+
+class TestHistoryDB(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        self.path = os.path.join(tmp, "history.db")
+        patcher = mock.patch("history_db.DB_PATH", self.path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(history_db.close)
+        history_db.init_db()
+
+    def rows(self):
+        conn = sqlite3.connect(self.path)
+        rows = conn.execute("SELECT user_email, keyword FROM searches ORDER BY id").fetchall()
+        conn.close()
+        return rows
+
+    def test_recent_searches_are_served_before_they_are_written(self):
+        with mock.patch("history_db.FLUSH_INTERVAL", 60):
+            for i in range(12):
+                history_db.log_search("a@x.test", "word%d" % i)
+            history_db.log_search("b@x.test", "other")
+
+            self.assertEqual(history_db.get_recent_searches("a@x.test"), ["word%d" % i for i in range(11, 1, -1)])
+            self.assertEqual(history_db.get_recent_searches("b@x.test", limit=3), ["other"])
+            self.assertEqual(self.rows(), [], "searches are written in the background")
+
+            history_db.flush()
+            self.assertEqual(len(self.rows()), 13, "one batch holds every pending search")
+
+    def test_history_survives_a_restart(self):
+        history_db.log_search("a@x.test", "first")
+        history_db.log_search("a@x.test", "second")
+        history_db.close()
+
+        history_db.log_search("a@x.test", "third")
+        self.assertEqual(history_db.get_recent_searches("a@x.test"), ["third", "second", "first"])
+        self.assertEqual(history_db.get_recent_searches("a@x.test", limit=20), ["third", "second", "first"])
+
+    def test_trim_keeps_the_newest_searches_of_every_user(self):
+        for i in range(15):
+            history_db.log_search("a@x.test", "a%d" % i)
+        for i in range(3):
+            history_db.log_search("b@x.test", "b%d" % i)
+        history_db.flush()
+        history_db.trim()
+
+        rows = self.rows()
+        self.assertEqual([k for u, k in rows if u == "a@x.test"], ["a%d" % i for i in range(5, 15)])
+        self.assertEqual([k for u, k in rows if u == "b@x.test"], ["b0", "b1", "b2"])
+
+    def test_reads_use_the_user_timestamp_index(self):
+        conn = sqlite3.connect(self.path)
+        plan = conn.execute("EXPLAIN QUERY PLAN SELECT keyword FROM searches WHERE user_email=? "
+                            "ORDER BY timestamp DESC, id DESC LIMIT 10", ("a@x.test",)).fetchall()
+        conn.close()
+        self.assertIn("searches_user_time", " ".join(row[-1] for row in plan))
+
+
+if __name__ == "__main__":
+    unittest.main()
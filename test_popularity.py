@@ -0,0 +1,124 @@
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+from collections import Counter
+from unittest import mock
+
+import popularity
+from popularity import CountMinSketch, PopularKeywords
+
+# python -m unittest test_popularity.py
+
+class TestPopularity(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        self.path = os.path.join(tmp, "popularity.db")
+
+    def popular(self, **kwargs):
+        popular = PopularKeywords(self.path, **kwargs)
+        self.addCleanup(popular.close)
+        return popular
+
+    def searches(self, n, seed=0):
+        # a few keywords are searched a lot, most only a few times
+        rng = random.Random(seed)
+        return ["word%d" % int(rng.paretovariate(1.2)) for _ in range(n)]
+
+    def test_sketch_never_underestimates(self):
+        sketch = CountMinSketch(width=1024, depth=4)
+        counts = Counter(self.searches(20000))
+        for word, count in counts.items():
+            sketch.add(word, count)
+        for word, count in counts.items():
+            self.assertGreaterEqual(sketch.estimate(word), count)
+        self.assertEqual(sketch.estimate("word1"), counts["word1"])
+
+    def test_most_common_matches_counter(self):
+        words = self.searches(20000)
+        popular = self.popular(k=20, sync_interval=60)
+        for i in range(0, len(words), 3):
+            popular.add(words[i:i + 3])
+
+        expected = Counter(words).most_common(10)
+        self.assertEqual([word for word, _ in popular.most_common(10)], [word for word, _ in expected])
+        self.assertEqual(popular.most_common(10)[0], expected[0])
+        self.assertEqual(len(popular.most_common()), 20)
+
+    def test_workers_share_and_keep_their_counts(self):
+        first = self.popular(k=5, sync_interval=60)
+        second = self.popular(k=5, sync_interval=60)
+        first.add(["cat"] * 3 + ["dog"])
+        second.add(["dog"] * 4 + ["fish"])
+        self.assertEqual(second.most_common(1), [("dog", 4)], "other workers' searches show after a sync")
+
+        first.sync()
+        second.sync()
+        self.assertEqual(second.most_common(), [("dog", 5), ("cat", 3), ("fish", 1)])
+        second.sync()
+        self.assertEqual(second.most_common(1), [("dog", 5)], "a sync with nothing new counts nothing twice")
+
+        restarted = self.popular(k=5, sync_interval=60)
+        self.assertEqual(restarted.most_common(), [("dog", 5), ("cat", 3), ("fish", 1)])
+
+    def test_syncing_does_not_block_searches(self):
+        popular = self.popular(k=5, sync_interval=60)
+        popular.add(["cat"])
+        blocker = sqlite3.connect(self.path, isolation_level=None)
+        blocker.execute("BEGIN IMMEDIATE") # another worker in the middle of its sync
+        syncing = threading.Thread(target=popular.sync)
+        syncing.start()
+        time.sleep(0.1)
+
+        # counting a search takes neither the database nor a lock the sync holds
+        with mock.patch.object(popularity.sqlite3, "connect", side_effect=AssertionError("opened the database")):
+            popular.add(["cat", "dog"])
+            self.assertEqual(popular.most_common(), [("cat", 2), ("dog", 1)])
+        self.assertTrue(popular._sync_lock.locked(), "searches are counted while the sync waits")
+        blocker.execute("COMMIT")
+        blocker.close()
+        syncing.join()
+
+        self.assertEqual(popular.most_common(), [("cat", 2), ("dog", 1)])
+        popular.sync()
+        self.assertEqual(self.popular(k=5).most_common(), [("cat", 2), ("dog", 1)])
+
+    def test_failed_sync_keeps_the_counts(self):
+        popular = self.popular(k=5, sync_interval=60)
+        good_path, popular.path = popular.path, os.path.dirname(self.path) # not a database
+        popular.add(["cat", "cat"])
+        with self.assertRaises(sqlite3.Error):
+            popular.sync()
+        popular.close() # logs the failure instead of raising it
+        self.assertEqual(popular.most_common(), [("cat", 2)])
+
+        popular.path = good_path
+        popular.sync()
+        self.assertEqual(self.popular(k=5).most_common(), [("cat", 2)])
+
+    def test_background_sync_shares_counts(self):
+        first = self.popular(k=5, sync_interval=0.05)
+        second = self.popular(k=5, sync_interval=0.05)
+        first.add(["cat"] * 3)
+        second.most_common() # starts its syncer
+        for _ in range(100):
+            if second.most_common() == [("cat", 3)]:
+                break
+            time.sleep(0.02)
+        self.assertEqual(second.most_common(), [("cat", 3)])
+
+    def test_memory_does_not_grow_with_distinct_keywords(self):
+        popular = self.popular(k=20, width=1024, sync_interval=60)
+        popular.add("word%d" % i for i in range(50000))
+        popular.sync()
+        self.assertEqual(popular._counts.table.shape, (4, 1024))
+        self.assertEqual(len(popular.most_common()), 20)
+
+
+if __name__ == "__main__":
+    unittest.main()
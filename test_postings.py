@@ -0,0 +1,86 @@
+import random
+import unittest
+from unittest import mock
+
+import postings as postings_module
+from postings import PostingList, encode_positions, decode_positions
+
+# python -m unittest test_postings.py
+
+class TestPostings(unittest.TestCase):
+    def make_postings(self, num_docs, seed=0):
+        rng = random.Random(seed)
+        postings = {}
+        for doc_id in rng.sample(range(1, num_docs * 10), num_docs):
+            positions = sorted(rng.sample(range(1000), rng.randint(1, 5)))
+            postings[doc_id] = (len(positions), rng.randint(-3, 7), rng.randint(-10, 40), positions)
+        return postings
+
+    def test_positions_round_trip(self):
+        positions = [0, 1, 5, 127, 128, 300, 100000]
+        self.assertEqual(decode_positions(encode_positions(positions)), positions)
+        self.assertEqual(decode_positions(encode_positions([])), [])
+
+    def test_posting_list_reads_like_a_dict(self):
+        postings = self.make_postings(200)
+        plist = PostingList()
+        for doc_id, stats in postings.items():
+            plist.add(doc_id, *stats)
+
+        self.assertEqual(len(plist), 200)
+        self.assertEqual(list(plist), list(postings), "documents come back in the order they were added")
+        self.assertEqual(dict(plist.items()), postings)
+        for doc_id, stats in postings.items():
+            self.assertIn(doc_id, plist)
+            self.assertEqual(plist[doc_id], stats)
+        self.assertNotIn(0, plist)
+        self.assertIsNone(plist.get(0))
+        with self.assertRaises(KeyError):
+            plist[0]
+
+    def test_pop_removes_documents(self):
+        postings = self.make_postings(200)
+        plist = PostingList()
+        for doc_id, stats in postings.items():
+            plist.add(doc_id, *stats)
+
+        for doc_id in list(postings)[::3]:
+            self.assertEqual(plist.pop(doc_id), postings.pop(doc_id))
+            self.assertNotIn(doc_id, plist)
+        self.assertIsNone(plist.pop(0))
+        self.assertEqual(len(plist), len(postings))
+        self.assertEqual(list(plist.items()), list(postings.items()))
+
+        # a document indexed again after a recrawl goes to the end
+        doc_id = next(iter(postings))
+        stats = postings.pop(doc_id)
+        plist.pop(doc_id)
+        plist.add(doc_id, *stats)
+        postings[doc_id] = stats
+        self.assertEqual(list(plist.items()), list(postings.items()))
+        self.assertEqual(sorted(plist.rows()), sorted((d,) + s[:3] + (encode_positions(s[3]),)
+                                                      for d, s in postings.items()))
+
+    def test_lookups_do_not_decode_the_whole_list(self):
+        plist = PostingList()
+        for doc_id in range(50000):
+            plist.add(doc_id, 1, 0, 0, [doc_id % 100])
+        plist.get(0) # builds the offsets once
+
+        with mock.patch.object(postings_module, "_decode_entry", wraps=postings_module._decode_entry) as decode:
+            for doc_id in range(0, 50000, 50):
+                self.assertIn(doc_id, plist)
+                plist.pop(doc_id)
+        self.assertEqual(decode.call_count, 1000, "a pop only decodes the entry it removes")
+        self.assertEqual(len(plist), 49000)
+
+        doc_ids = list(plist)
+        with mock.patch.object(postings_module, "_decode_entry", wraps=postings_module._decode_entry) as decode:
+            for doc_id in doc_ids:
+                plist.pop(doc_id)
+        self.assertLess(decode.call_count, 3 * 49000, "compacting the removed entries away stays linear")
+        self.assertEqual(len(plist), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
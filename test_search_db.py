@@ -0,0 +1,255 @@
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from difflib import SequenceMatcher
+from unittest import mock
+
+import search_db
+from crawler import crawler
+
+# python -m unittest test_search_db.py
+
+def build_index(db_file, pages, backend="sqlite"):
+    """Crawl pages, {url: html}, from memory starting at the first url and store the index in db_file."""
+    bot = crawler(None, "empty.txt", db_file=db_file)
+    bot._fetch = lambda url, timeout, validators=None: pages[url].encode()
+    bot._url_queue = [(next(iter(pages)), 0)]
+    bot.crawl(depth=len(pages))
+    bot.compute_page_rank()
+    bot.store_to_database(backend=backend)
+
+def random_site(num_pages=40, vocabulary=600, seed=0):
+    """Return pages of random words, each linking to the next two."""
+    rng = random.Random(seed)
+    words = sorted({"".join(rng.choice("abcdefghilmnoprstu") for _ in range(rng.randint(3, 9)))
+                    for _ in range(vocabulary)})
+    pages = {}
+    for i in range(num_pages):
+        text = " ".join(rng.choice(words[:rng.randint(50, len(words))]) for _ in range(60))
+        links = "".join('<a href="http://site.test/%d">next</a>' % j for j in (i + 1, i + 2) if j < num_pages)
+        pages["http://site.test/%d" % i] = "<html><body><p>%s</p>%s</body></html>" % (text, links)
+    return pages
+
+
+class TestSearchDB(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        self.db_file = os.path.join(tmp, "search_engine.db")
+        self.segment_file = os.path.join(tmp, "search_engine.seg")
+        for name, path in (("DB_PATH", self.db_file), ("SEGMENT_PATH", self.segment_file)):
+            patcher = mock.patch.object(search_db, name, path)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        # go back to the index the module loaded once the paths are restored
+        self.addCleanup(search_db.refresh_index)
+
+    def use_index(self, pages, backend="sqlite"):
+        build_index(self.db_file, pages, backend)
+        search_db.refresh_index()
+
+    def lexicon(self):
+        """(word, df) of every lexicon row, in word_id order."""
+        conn = sqlite3.connect(self.db_file)
+        rows = conn.execute("SELECT word, df FROM lexicon ORDER BY word_id").fetchall()
+        conn.close()
+        return rows
+
+    def test_fuzzy_match_equals_a_full_scan(self):
+        self.use_index(random_site())
+        words = [word for word, _ in self.lexicon()]
+        queries = ["zzz", "ab", "x"] + [w[:-1] + "q" for w in words[::60]] + [w + "e" for w in words[::75]]
+        for query in queries:
+            if query in words:
+                continue
+            scores = [(word, SequenceMatcher(None, query, word.lower()).ratio()) for word in words]
+            expected = sorted((ws for ws in scores if ws[1] >= 0.3), key=lambda ws: ws[1], reverse=True)[:5]
+            matches = search_db.lexicon_fuzzy_match(query)
+            self.assertEqual([(m["word"], m["score"]) for m in matches], expected, query)
+
+        exact = search_db.lexicon_fuzzy_match(words[3])
+        self.assertEqual([(m["word"], m["score"]) for m in exact], [(words[3], 1.0)])
+
+    def test_fuzzy_index_counts_long_runs_of_a_character(self):
+        word = "a" * 300 + "b" * 70000
+        _, _, char_matrix, _ = search_db.build_fuzzy_index([{"word": word}])
+        counts = dict(zip("ab", char_matrix[0][[0, 1]].tolist()))
+        self.assertEqual(counts, {"a": 300, "b": 65535})
+        self.assertEqual(search_db._char_counts(word).tolist(), char_matrix[0].tolist())
+
+    def test_suggestions_equal_a_prefix_filter(self):
+        self.use_index(random_site())
+        lexicon = sorted((word.lower(), df) for word, df in self.lexicon())
+        for prefix in ["a", "s", "pr", "ta", "xyz"] + [word[:3] for word, _ in lexicon[::40]]:
+            matching = sorted((ws for ws in lexicon if ws[0].startswith(prefix)), key=lambda ws: (-ws[1], ws[0]))
+            for limit in (5, 10, 20):
+                self.assertEqual(search_db.suggest_words(prefix, limit), [w for w, _ in matching[:limit]],
+                                 (prefix, limit))
+        self.assertEqual(search_db.suggest_words(""), [])
+
+    def test_paged_results_equal_one_large_page(self):
+        self.use_index(random_site())
+        words = [word for word, _ in self.lexicon()]
+        for query in [words[0], words[1] + " " + words[2], words[10][:-1]]:
+            paged = []
+            page = 1
+            while True:
+                results = search_db.search_db(query, page, per_page=3)
+                if not results:
+                    break
+                paged.extend(results)
+                page += 1
+            search_db._index.search_cache.clear()
+            everything = search_db.search_db(query, 1, per_page=1000)
+
+            self.assertGreater(len(everything), 3, query)
+            self.assertEqual(paged, everything, query)
+            scores = [r["final_score"] for r in everything]
+            self.assertEqual(scores, sorted(scores, reverse=True))
+
+    def test_simple_search_is_the_same_on_both_backends(self):
+        site = random_site()
+        words = [word for word, _ in (self.use_index(site) or self.lexicon())][::25]
+        pages = {word: [search_db.search_db_simple(word, page, per_page=3) for page in (1, 2, 3)] for word in words}
+        self.use_index(site, backend="segment")
+        for word in words:
+            self.assertEqual([search_db.search_db_simple(word, page, per_page=3) for page in (1, 2, 3)], pages[word])
+        self.assertTrue(any(results for results in pages.values()))
+
+    def test_simple_search_sees_a_rebuilt_index(self):
+        self.use_index({"http://site.test/": "<html><body><p>quince</p></body></html>"})
+        self.assertEqual(len(search_db.search_db_simple("quince", 1)), 1)
+        # built next to it and moved over it, so the open connections keep reading the old file
+        build_index(self.db_file + ".new", {"http://site.test/": "<html><body><p>zebra kiwi</p></body></html>"})
+        os.replace(self.db_file + ".new", self.db_file)
+        self.assertEqual(search_db.search_db_simple("quince", 1), [])
+        self.assertEqual(len(search_db.search_db_simple("kiwi", 1)), 1)
+
+    def test_searches_read_their_own_version_during_a_reload(self):
+        from concurrent.futures import ThreadPoolExecutor
+        self.use_index({"http://a.test/": "<html><body><p>quince</p></body></html>"})
+        index = search_db.refresh_index()
+        worker = ThreadPoolExecutor(max_workers=1) # one thread, so one pooled connection
+        self.addCleanup(worker.shutdown)
+        urls = lambda index: [r["url"] for r in search_db._result_details([(1, 1.0)], index)]
+        self.assertEqual(worker.submit(urls, index).result(), ["http://a.test/"])
+
+        build_index(self.db_file + ".new", {"http://b.test/": "<html><body><p>kiwi</p></body></html>"})
+        os.replace(self.db_file + ".new", self.db_file)
+        during = []
+        build_prefix_index = search_db.build_prefix_index
+        def build_and_search(lexicon):
+            # a search that took the old index keeps reading the old file while the new index loads
+            during.append(worker.submit(urls, index).result())
+            return build_prefix_index(lexicon)
+        with mock.patch.object(search_db, "build_prefix_index", build_and_search):
+            new_index = search_db.refresh_index()
+        self.assertEqual(during, [["http://a.test/"]])
+        self.assertEqual(worker.submit(urls, new_index).result(), ["http://b.test/"])
+
+    def test_searches_survive_index_rebuilds(self):
+        import threading
+        import time
+        sites = []
+        for i, num_pages in enumerate((30, 12)):
+            path = os.path.join(os.path.dirname(self.db_file), "site%d.db" % i)
+            build_index(path, random_site(num_pages=num_pages, vocabulary=300 * (i + 1), seed=i))
+            sites.append(path)
+        shutil.copy(sites[0], self.db_file)
+        search_db.refresh_index()
+
+        errors = []
+        stop = time.monotonic() + 1.0
+        def search(seed):
+            rng = random.Random(seed)
+            while time.monotonic() < stop:
+                query = "".join(rng.choice("abcdefghilmnoprstu") for _ in range(rng.randint(2, 6)))
+                try:
+                    search_db.search_db(query, rng.randint(1, 3))
+                    search_db.suggest_words(query[:rng.randint(1, 3)], rng.choice((5, 20)))
+                    search_db.search_db_simple(query, 1)
+                except Exception as e:
+                    errors.append(e)
+        threads = [threading.Thread(target=search, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        i = 0
+        while time.monotonic() < stop:
+            i += 1
+            shutil.copy(sites[i % 2], self.db_file + ".new")
+            os.replace(self.db_file + ".new", self.db_file)
+            search_db.refresh_index()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def test_leftover_segment_does_not_shadow_a_new_table(self):
+        self.use_index({"http://site.test/": "<html><body><p>quince</p></body></html>"}, backend="segment")
+        self.assertEqual([r["url"] for r in search_db.search_db("quince", 1)], ["http://site.test/"])
+        stale = self.segment_file + ".stale"
+        shutil.copy(self.segment_file, stale)
+
+        # a server refreshing between the sqlite build's commit and its removal of the old segment
+        self.use_index({"http://site.test/": "<html><body><p>zebra kiwi</p></body></html>"})
+        shutil.copy(stale, self.segment_file)
+        os.utime(self.db_file, ns=(0, 0))
+        search_db.refresh_index()
+
+        self.assertEqual(search_db.search_db("quince", 1), [])
+        self.assertEqual([r["url"] for r in search_db.search_db("kiwi", 1)], ["http://site.test/"])
+
+    def test_forked_workers_share_the_index_until_a_rebuild(self):
+        import multiprocessing
+        self.use_index({"http://site.test/": "<html><body><p>quince</p></body></html>"})
+        index = search_db.refresh_index()
+        ctx = multiprocessing.get_context("fork")
+        def worker(results):
+            fresh = search_db.refresh_index()
+            results.put((fresh is index, len(search_db.search_db_simple("kiwi", 1))))
+        def run_worker():
+            results = ctx.Queue()
+            process = ctx.Process(target=worker, args=(results,))
+            process.start()
+            result = results.get(timeout=30)
+            process.join()
+            return result
+
+        self.assertEqual(run_worker(), (True, 0), "a worker uses the index loaded before the fork")
+        build_index(self.db_file + ".new", {"http://site.test/": "<html><body><p>zebra kiwi</p></body></html>"})
+        os.replace(self.db_file + ".new", self.db_file)
+        self.assertEqual(run_worker(), (False, 1), "after a rebuild a worker loads its own copy")
+        self.assertIs(search_db._index, index, "and the parent's index is left as it was")
+
+    def test_segment_is_only_read_with_its_database(self):
+        self.use_index({"http://site.test/": "<html><body><p>quince</p></body></html>"}, backend="segment")
+        with open(self.segment_file, "rb") as f:
+            quince_segment = f.read()
+        kiwi_site = {"http://site.test/": "<html><body><p>zebra kiwi</p></body></html>"}
+
+        # a build that fails to commit leaves the segment alone
+        with mock.patch.object(crawler, "_bulk_load", side_effect=sqlite3.OperationalError("disk is full")):
+            with self.assertRaises(sqlite3.OperationalError):
+                build_index(self.db_file, kiwi_site, backend="segment")
+        with open(self.segment_file, "rb") as f:
+            self.assertEqual(f.read(), quince_segment)
+        self.assertFalse(os.path.exists(self.segment_file + ".tmp"))
+        self.assertEqual([r["url"] for r in search_db.search_db("quince", 1)], ["http://site.test/"])
+
+        # a server refreshing between a build's commit and its move of the new segment
+        index = search_db.refresh_index()
+        build_index(self.db_file, kiwi_site, backend="segment")
+        os.replace(self.segment_file, self.segment_file + ".new")
+        with open(self.segment_file, "wb") as f:
+            f.write(quince_segment)
+        self.assertIs(search_db.refresh_index(), index)
+        self.assertIs(search_db.refresh_index(), index)
+        os.replace(self.segment_file + ".new", self.segment_file)
+        self.assertEqual(search_db.search_db("quince", 1), [])
+        self.assertEqual([r["url"] for r in search_db.search_db("kiwi", 1)], ["http://site.test/"])
+
+
+if __name__ == "__main__":
+    unittest.main()